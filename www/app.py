@@ -2,38 +2,64 @@
 # @author xian_wen
 # @date 5/26/2021 2:06 PM
 
-import json
+import asyncio
 import logging
+import math
 import os
+import signal
 import time
 from datetime import datetime
 
-from aiohttp import web
-from jinja2 import Environment, FileSystemLoader
+from aiohttp import hdrs, web
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 
+import assets
+import compression
+import encoder
+import logs
+import metrics
 import orm
+import passwords
+import ratelimit
+from cache import CachedResponse, LRUCache
 from coroweb import add_routes, add_static
 from config import configs
-from handlers import COOKIE_NAME, cookie2user
+from handlers import COOKIE_NAME, configure_session_cache, cookie2user
+from models import Blog
 
-logging.basicConfig(level=logging.INFO)
+# 作为脚本运行时 __name__ 为 __main__，固定名称以便按模块配置级别
+logger = logging.getLogger('app')
+# 每个请求一条的日志，按 configs.logging.sample_rate 采样
+request_logger = logging.getLogger('app.request')
+
+# 日志由后台线程写出，事件循环只负责入队
+logs.init_logging(**configs.logging)
 
 
 def init_jinja2(app, **kwargs):
-    logging.info('Init jinja2...')
+    logger.info('Init jinja2...')
     options = dict(
         autoescape=kwargs.get('autoescape', True),
         block_start_string=kwargs.get('block_start_string', '{%'),
         block_end_string=kwargs.get('block_end_string', '%}'),
         variable_start_string=kwargs.get('variable_start_string', '{{'),
         variable_end_string=kwargs.get('variable_end_string', '}}'),
-        auto_reload=kwargs.get('auto_reload', True)
+        auto_reload=kwargs.get('auto_reload', True),
+        # 异步渲染，支持边渲染边发送
+        enable_async=kwargs.get('enable_async', False)
     )
     path = kwargs.get('path', None)
     if path is None:
         # /www/templates
         path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
-    logging.info('Set jinja2 template path: %s' % path)
+    logger.info('Set jinja2 template path: %s', path)
+    bytecode_cache = kwargs.get('bytecode_cache', None)
+    if bytecode_cache is not None:
+        # 编译后的模板保存在磁盘上，重启后无需重新编译，'' 表示使用系统临时目录
+        logger.info('Set jinja2 bytecode cache: %s', bytecode_cache or 'default')
+        # 同步和异步模板编译出的代码不同，分开缓存
+        pattern = '__jinja2_async_%s.cache' if options['enable_async'] else '__jinja2_%s.cache'
+        options['bytecode_cache'] = FileSystemBytecodeCache(bytecode_cache or None, pattern)
     # Load templates from a directory in the file system
     env = Environment(loader=FileSystemLoader(path), **options)
     filters = kwargs.get('filters', None)
@@ -41,26 +67,209 @@ def init_jinja2(app, **kwargs):
         # Filters are Python functions
         for name, f in filters.items():
             env.filters[name] = f
+    # 所有模板可用的函数，如 static_url
+    env.globals.update(kwargs.get('globals', None) or {})
+    if kwargs.get('precompile', False):
+        # 启动时编译所有模板，语法错误直接抛出 TemplateSyntaxError
+        names = env.list_templates(extensions=['html'])
+        for name in names:
+            env.get_template(name)
+        logger.info('Precompiled %s jinja2 templates', len(names))
     app['__templating__'] = env
 
 
+async def render_stream(request, template, kwargs):
+    """
+    Render template asynchronously and flush chunks as soon as they are rendered.
+    """
+    resp = web.StreamResponse()
+    resp.content_type = 'text/html'
+    resp.charset = 'UTF-8'
+    if configs.compression.enabled:
+        # 边渲染边发送时由 aiohttp 逐块压缩
+        resp.enable_compression()
+    await resp.prepare(request)
+    buf = []
+    size = 0
+    async for chunk in template.generate_async(**kwargs):
+        buf.append(chunk)
+        size += len(chunk)
+        # 攒够一定大小再发送，避免过多的小块写入
+        if size >= 8192:
+            await resp.write(''.join(buf).encode('utf-8'))
+            buf = []
+            size = 0
+    if buf:
+        await resp.write(''.join(buf).encode('utf-8'))
+    await resp.write_eof()
+    return resp
+
+
+async def metrics_factory(app, handler):
+    if not configs.metrics.enabled:
+        return handler
+
+    async def instrument(request):
+        token = metrics.start_request()
+        start = time.perf_counter()
+        try:
+            return await handler(request)
+        finally:
+            route = request.match_info.route.resource
+            metrics.finish_request(token, route.canonical if route is not None else 'unmatched',
+                                   time.perf_counter() - start)
+
+    return instrument
+
+
 async def logger_factory(app, handler):
-    async def logger(request):
-        logging.info('Request: %s %s' % (request.method, request.path))
+    async def log(request):
+        if not request_logger.isEnabledFor(logging.INFO):
+            return await handler(request)
+        start = time.perf_counter()
+        status = 500
+        try:
+            r = await handler(request)
+            status = r.status
+            return r
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            ms = (time.perf_counter() - start) * 1000
+            request_logger.info('%s %s %s %.1fms', request.method, request.path, status, ms,
+                                extra=dict(method=request.method, path=request.path, status=status, ms=ms))
+
+    return log
+
+
+async def compression_factory(app, handler):
+    if not configs.compression.enabled:
+        return handler
+
+    def compressible(body, content_type):
+        return len(body) >= configs.compression.min_size and assets.compressible(content_type)
+
+    def vary_and_validate(request, resp):
+        """
+        Add Vary: Accept-Encoding and weaken the ETag if the body is sent compressed.
+
+        :return: the encoding, None if sent uncompressed
+        """
+        vary = resp.headers.get(hdrs.VARY)
+        resp.headers[hdrs.VARY] = '%s, %s' % (vary, hdrs.ACCEPT_ENCODING) if vary else hdrs.ACCEPT_ENCODING
+        encoding = compression.negotiate(request.headers.get(hdrs.ACCEPT_ENCODING, ''))
+        etag = resp.headers.get(hdrs.ETAG)
+        if encoding is not None and etag and not etag.startswith('W/'):
+            # 压缩后字节不同，改为弱 ETag，If-None-Match 仍能匹配
+            resp.headers[hdrs.ETAG] = 'W/' + etag
+        return encoding
+
+    async def compress(request):
+        resp = await handler(request)
+        entry = resp.get('__page_cache_entry__') if isinstance(resp, web.StreamResponse) else None
+        if resp.status == 304:
+            # 304 须带有与 200 相同的 ETag 和 Vary
+            if entry is not None and compressible(entry.body, entry.content_type):
+                vary_and_validate(request, resp)
+            return resp
+        # 跳过流式响应、FileResponse、已压缩和不值得压缩的响应
+        if (type(resp) is not web.Response or resp.status != 200 or not isinstance(resp.body, bytes)
+                or hdrs.CONTENT_ENCODING in resp.headers or not compressible(resp.body, resp.content_type)):
+            return resp
+        encoding = vary_and_validate(request, resp)
+        if encoding is None:
+            return resp
+        start = time.perf_counter()
+        # 缓存的页面只压缩一次
+        body = entry.encoded.get(encoding) if entry is not None else None
+        if body is None:
+            body = await compression.compress(resp.body, encoding)
+            if entry is not None:
+                entry.encoded[encoding] = body
+        metrics.add_time('compress', time.perf_counter() - start)
+        resp.body = body
+        resp.headers[hdrs.CONTENT_ENCODING] = encoding
+        return resp
+
+    return compress
+
+
+async def rate_limit_factory(app, handler):
+    async def rate_limit(request):
+        # 在读取用户和执行 handler 之前拒绝超出频率的请求
+        limits = getattr(request.match_info.handler, '__rate_limit__', None)
+        if not limits or not configs.rate_limit.enabled:
+            return await handler(request)
+        for key, (capacity, period) in limits.items():
+            value = await ratelimit.limit_value(request, key, configs.rate_limit.ip_header)
+            if value is None:
+                continue
+            allowed, retry_after = await ratelimit.take('%s:%s:%s' % (request.match_info.route.resource.canonical,
+                                                                      key, value), capacity, period)
+            if not allowed:
+                request_logger.warning('Rate limited: %s %s %s=%s', request.method, request.path, key, value)
+                resp = web.Response(status=429, body=encoder.dumps(
+                    dict(error='Rate: limited', data=key, message='Too many requests.')))
+                resp.content_type = 'application/json; charset=UTF-8'
+                resp.headers[hdrs.RETRY_AFTER] = str(math.ceil(retry_after))
+                return resp
         return await handler(request)
 
-    return logger
+    return rate_limit
+
+
+# 客户端最后一次写入的时间，使重定向后的 GET 等后续请求在时间窗口内读主库
+LAST_WRITE_COOKIE = 'awelastwrite'
+
+
+async def read_your_writes_factory(app, handler):
+    if not configs.db.replicas or not configs.db.read_your_writes:
+        return handler
+
+    def set_cookie(resp, w):
+        # 流式响应已发送响应头，无法再设置 cookie
+        if w.changed and not resp.prepared:
+            resp.set_cookie(LAST_WRITE_COOKIE, '%.3f' % w.at, max_age=math.ceil(configs.db.read_your_writes),
+                            httponly=True)
+
+    async def read_your_writes(request):
+        try:
+            last_write = float(request.cookies[LAST_WRITE_COOKIE])
+        except (KeyError, ValueError):
+            last_write = None
+        with orm.read_your_writes(last_write) as w:
+            try:
+                r = await handler(request)
+            except web.HTTPException as e:
+                set_cookie(e, w)
+                raise
+        set_cookie(r, w)
+        return r
+
+    return read_your_writes
+
+
+async def identity_map_factory(app, handler):
+    async def identity_map(request):
+        # 同一请求内相同主键的 find 只查询一次
+        with orm.identity_map():
+            return await handler(request)
+
+    return identity_map
 
 
 async def auth_factory(app, handler):
     async def auth(request):
-        logging.info('Check user: %s %s' % (request.method, request.path))
+        request_logger.debug('Check user: %s %s', request.method, request.path)
         request.__user__ = None
         cookie_str = request.cookies.get(COOKIE_NAME)
         if cookie_str:
+            start = time.perf_counter()
             user = await cookie2user(cookie_str)
+            metrics.add_time('auth', time.perf_counter() - start)
             if user:
-                logging.info('Set current user: %s' % user.email)
+                request_logger.debug('Set current user: %s', user.email)
                 request.__user__ = user
         if request.path.startswith('/manage/') and (request.__user__ is None or not request.__user__.admin):
             return web.HTTPFound('/signin')
@@ -69,18 +278,61 @@ async def auth_factory(app, handler):
     return auth
 
 
+async def page_cache_factory(app, handler):
+    cache = app['__page_cache__']
+
+    async def page_cache(request):
+        # 只缓存匿名用户的 GET 页面，路由通过 @get(path, cache=True) 开启
+        if (request.method != 'GET' or request.__user__ is not None
+                or not getattr(request.match_info.handler, '__cache__', False)):
+            return await handler(request)
+        key = request.path_qs
+        entry = cache.get(key)
+        if entry is None:
+            r = await handler(request)
+            if type(r) is not web.Response or r.status != 200 or r.cookies or not isinstance(r.body, bytes):
+                return r
+            entry = CachedResponse(r.body, r.headers.get(hdrs.CONTENT_TYPE))
+            cache.set(key, entry)
+        else:
+            request_logger.debug('Page cache hit: %s', key)
+        if_modified_since = request.if_modified_since
+        if entry.not_modified(request.headers.get(hdrs.IF_NONE_MATCH),
+                              if_modified_since.timestamp() if if_modified_since else None):
+            resp = web.Response(status=304)
+        else:
+            resp = web.Response(body=entry.body, headers={hdrs.CONTENT_TYPE: entry.content_type})
+        # 供 compression 压缩一次后缓存，或为 304 设置与 200 相同的 ETag 和 Vary
+        resp['__page_cache_entry__'] = entry
+        resp.headers[hdrs.ETAG] = entry.etag
+        resp.last_modified = entry.last_modified
+        # 登录后同一 URL 内容不同，要求浏览器每次验证
+        resp.headers[hdrs.CACHE_CONTROL] = 'no-cache'
+        resp.headers[hdrs.VARY] = 'Cookie'
+        return resp
+
+    return page_cache
+
+
+def init_page_cache(app, ttl):
+    cache = LRUCache(configs.page_cache.size, ttl)
+    # 日志改变后，所有缓存的页面失效
+    orm.on_change(Blog, lambda blog, action: cache.clear())
+    app['__page_cache__'] = cache
+
+
 async def data_factory(app, handler):
     async def parse_data(request):
         # JSON 数据格式
         if request.content_type.startswith('application/json'):
             # Read request body decoded as json
             request.__data__ = await request.json()
-            logging.info('Request json: %s' % str(request.__data__))
+            request_logger.debug('Request json: %s', request.__data__)
         # form 表单数据被编码为 key/value 格式发送到服务器（表单默认的提交数据的格式）
         elif request.content_type.startswith('application/x-www-form-urlencoded'):
             # Read POST parameters from request body
             request.__data__ = await request.post()
-            logging.info('Request form: %s' % str(request.__data__))
+            request_logger.debug('Request form: %s', request.__data__)
         return await handler(request)
 
     return parse_data
@@ -88,7 +340,7 @@ async def data_factory(app, handler):
 
 async def response_factory(app, handler):
     async def response(request):
-        logging.info('Response handler...')
+        request_logger.debug('Response handler...')
         r = await handler(request)
         # The base class for the HTTP response handling
         if isinstance(r, web.StreamResponse):
@@ -110,17 +362,31 @@ async def response_factory(app, handler):
             # 模板参数
             template = r.get('__template__')
             if template is None:
-                resp = web.Response(
-                    # ensure_ascii: if false then return value can contain non-ASCII characters
-                    # __dict__: store an object’s (writable) attributes
-                    # 序列化 r 为 json 字符串，default 把任意一个对象变成一个可序列为 JSON 的对象
-                    body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+                # 序列化 r 为 UTF-8 编码的 json bytes
+                start = time.perf_counter()
+                body = encoder.dumps(r)
+                metrics.add_time('serialize', time.perf_counter() - start)
+                resp = web.Response(body=body)
                 # JSON 数据格式
                 resp.content_type = 'application/json; charset=UTF-8'
                 return resp
             else:
                 # app[__templating__] 是一个 Environment 对象，加载模板，渲染模板
-                resp = web.Response(body=app['__templating__'].get_template(template).render(**r).encode('utf-8'))
+                env = app['__templating__']
+                start = time.perf_counter()
+                if env.is_async:
+                    # 可缓存的页面需要完整的 body
+                    if getattr(request.match_info.handler, '__cache__', False):
+                        body = await env.get_template(template).render_async(**r)
+                    else:
+                        resp = await render_stream(request, env.get_template(template), r)
+                        metrics.add_time('template', time.perf_counter() - start)
+                        return resp
+                else:
+                    body = env.get_template(template).render(**r)
+                body = body.encode('utf-8')
+                metrics.add_time('template', time.perf_counter() - start)
+                resp = web.Response(body=body)
                 resp.content_type = 'text/html; charset=UTF-8'
                 return resp
         # Status Code
@@ -161,23 +427,100 @@ def datetime_filter(t):
 
 
 async def init_db(app):
+    orm.profiler.configure(slow_ms=configs.profiler.slow_ms, sample_rate=configs.profiler.sample_rate,
+                           explain=configs.profiler.explain)
+    if hasattr(signal, 'SIGUSR1'):
+        # kill -USR1 <pid> 输出耗时最多的语句
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, orm.profiler.log_top)
+    # 多个 worker 平均分配连接总数
+    workers = app['__workers__']
+    maxsize = max(1, configs.db.maxsize // workers)
     # If on Linux, use another user instead of 'root'
     await orm.create_pool(
         host=configs.db.host,
         port=configs.db.port,
         user=configs.db.user,
         password=configs.db.password,
-        db=configs.db.database
+        db=configs.db.database,
+        minsize=min(configs.db.minsize, maxsize),
+        maxsize=maxsize,
+        acquire_timeout=configs.db.acquire_timeout,
+        pool_recycle=configs.db.pool_recycle,
+        pre_ping=configs.db.pre_ping,
+        replicas=configs.db.replicas,
+        replica_strategy=configs.db.replica_strategy,
+        read_your_writes=configs.db.read_your_writes
     )
+    logger.info('Database pool of worker %s: maxsize %s of %s', os.getpid(), maxsize, configs.db.maxsize)
+
+
+def init_assets(app):
+    """
+    Build fingerprinted and precompressed static files unless in debug mode.
+
+    :return: static_url(path) for templates
+    """
+    if configs.debug:
+        # 开发时直接使用 /static/ 下的原文件
+        return lambda path: '/static/' + path.lstrip('/')
+    a = assets.Assets(assets.static_dir(), configs.assets.build_dir or assets.default_dest(),
+                      configs.assets.gzip_level, configs.assets.brotli_quality).build()
+    a.add_route(app)
+    app['__assets__'] = a
+    return a.url
+
+
+async def close_db(app):
+    await orm.close_pool()
+
+
+async def close_passwords(app):
+    passwords.shutdown()
+
+
+def init_app(workers=1):
+    """
+    Create the application, the database pool is created on startup.
+
+    :param workers: number of worker processes sharing configs.db.maxsize connections
+    """
+    app = web.Application(middlewares=[
+        metrics_factory,
+        logger_factory,
+        compression_factory,
+        rate_limit_factory,
+        read_your_writes_factory,
+        identity_map_factory,
+        auth_factory,
+        page_cache_factory,
+        response_factory
+    ])
+    app['__workers__'] = workers
+    passwords.configure(**configs.passwords)
+    ratelimit.use(ratelimit.MemoryBackend(configs.rate_limit.maxsize))
+    compression.configure(configs.compression.gzip_level, configs.compression.brotli_quality,
+                          configs.compression.executor_size)
+    cache_ttl = configs.page_cache.ttl
+    if workers > 1:
+        # 写入只能使本 worker 的缓存失效，缩短有效期以限制其他 worker 使用旧 session 和页面的时间
+        cache_ttl = min(cache_ttl, configs.server.worker_cache_ttl)
+        configure_session_cache(min(configs.session.cache_ttl, configs.server.worker_cache_ttl))
+    init_page_cache(app, cache_ttl)
+    static_url = init_assets(app)
+    # 非 debug 模式下关闭模板自动重载，并在启动时预编译所有模板
+    init_jinja2(app, filters=dict(datetime=datetime_filter), globals=dict(static_url=static_url),
+                auto_reload=configs.debug, precompile=not configs.debug,
+                bytecode_cache=None if configs.debug else configs.templates.bytecode_cache,
+                enable_async=configs.templates.stream)
+    add_routes(app, 'handlers')
+    add_static(app)
+    app.on_startup.append(init_db)
+    app.on_cleanup.append(close_db)
+    app.on_cleanup.append(close_passwords)
+    return app
 
 
-app = web.Application(middlewares=[
-    logger_factory,
-    auth_factory,
-    response_factory
-])
-init_jinja2(app, filters=dict(datetime=datetime_filter))
-add_routes(app, 'handlers')
-add_static(app)
-app.on_startup.append(init_db)
-web.run_app(app, host='localhost', port=9000)
+if __name__ == '__main__':
+    # 单进程运行，多进程见 server.py
+    web.run_app(init_app(), host=configs.server.host, port=configs.server.port,
+                shutdown_timeout=configs.server.shutdown_timeout)
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+# @author xian_wen
+# @date 10/19/2026 9:15 AM
+
+"""
+Static asset pipeline: copy www/static to fingerprinted names with gzip and brotli variants, serve them
+with Cache-Control: immutable.
+
+Usage:
+    python assets.py                     # build ahead of deployment, startup then only hashes files
+    {{ static_url('js/vue.min.js') }}    # in templates, /assets/js/vue.min.<hash>.js
+"""
+
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import posixpath
+import re
+import tempfile
+
+from aiohttp import hdrs, web
+
+import compression
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# 值得压缩的类型，字体 woff/woff2 和图片本身已压缩
+COMPRESSIBLE_TYPES = frozenset([
+    'application/javascript', 'text/javascript', 'application/json', 'application/xml', 'image/svg+xml',
+    'application/vnd.ms-fontobject', 'font/ttf', 'font/otf', 'application/x-font-ttf', 'application/font-sfnt',
+])
+
+# 压缩后不小于原大小的该比例则不保存压缩版本
+MIN_RATIO = 0.9
+
+# 一年，文件名随内容改变，可以永久缓存
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+# CSS 中的 url(...) 引用，如 url(../fonts/fontawesome-webfont.woff?v=4.2.0)
+_RE_CSS_URL = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+
+
+def compressible(content_type):
+    return content_type is not None and (content_type.startswith('text/') or content_type in COMPRESSIBLE_TYPES)
+
+
+def fingerprint(path, digest):
+    """
+    css/uikit.min.css => css/uikit.min.<digest>.css
+    """
+    root, ext = os.path.splitext(path)
+    return '%s.%s%s' % (root, digest, ext)
+
+
+def _write(path, data):
+    # 先写临时文件再改名，多个 worker 同时构建时不会读到写了一半的文件
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+class Assets(object):
+    """
+    Fingerprinted copies of the files in src, built into dest.
+    """
+
+    def __init__(self, src, dest, gzip_level=9, brotli_quality=11):
+        self.src = src
+        self.dest = dest
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        # 源文件相对路径 => 带指纹的相对路径
+        self.urls = dict()
+        # 带指纹的相对路径 => (content type, {encoding: 文件路径})
+        self.files = dict()
+
+    def build(self):
+        """
+        Hash every file in src, write the fingerprinted copy and its compressed variants if not built yet.
+        A file with a .min sibling is served as the .min file.
+        """
+        paths = []
+        for root, dirs, names in os.walk(self.src):
+            for name in names:
+                path = os.path.relpath(os.path.join(root, name), self.src).replace(os.sep, '/')
+                base, ext = os.path.splitext(path)
+                if not base.endswith('.min') and os.path.isfile(os.path.join(self.src, base + '.min' + ext)):
+                    continue
+                paths.append(path)
+        # CSS 最后构建，其中引用的字体和图片此时已有带指纹的文件名
+        paths.sort(key=lambda p: p.endswith('.css'))
+        built = 0
+        for path in paths:
+            built += self.__build_file(path)
+        # 完整版本指向 .min 版本
+        for path in list(self.urls):
+            base, ext = os.path.splitext(path)
+            if base.endswith('.min'):
+                self.urls.setdefault(base[:-4] + ext, self.urls[path])
+        logger.info('Built %s of %s assets into %s%s', built, len(self.files), self.dest,
+                    '' if brotli else ' (brotli not installed)')
+        return self
+
+    def __build_file(self, path):
+        with open(os.path.join(self.src, path), 'rb') as f:
+            data = f.read()
+        if path.endswith('.css'):
+            # 先改写引用再计算指纹，被引用的文件改变时 CSS 的文件名也随之改变
+            data = self.__rewrite_css(path, data.decode('utf-8')).encode('utf-8')
+        name = fingerprint(path, hashlib.sha1(data).hexdigest()[:12])
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        target = os.path.join(self.dest, name)
+        variants = dict(identity=target)
+        built = 0
+        if not os.path.isfile(target):
+            _write(target, data)
+            built = 1
+        if compressible(content_type):
+            # 不使用 .gz 和 .br 后缀，否则 FileResponse 会按 Accept-Encoding 的子串自行选择压缩版本，忽略 q 值
+            encoders = [('gzip', '.gzip', lambda d: gzip.compress(d, self.gzip_level, mtime=0))]
+            if brotli is not None:
+                encoders.insert(0, ('br', '.brotli', lambda d: brotli.compress(d, quality=self.brotli_quality)))
+            for legacy in ('.gz', '.br'):
+                # 旧版本构建的压缩文件
+                if os.path.isfile(target + legacy):
+                    os.remove(target + legacy)
+            for encoding, suffix, compress in encoders:
+                # 压缩效果不好时只写入 .skip 标记，下次启动无需重新压缩
+                compressed_path = target + suffix
+                skip = compressed_path + '.skip'
+                if not os.path.isfile(compressed_path) and not os.path.isfile(skip):
+                    compressed = compress(data)
+                    if len(compressed) < len(data) * MIN_RATIO:
+                        _write(compressed_path, compressed)
+                    else:
+                        _write(skip, b'')
+                    built = 1
+                if os.path.isfile(compressed_path):
+                    variants[encoding] = compressed_path
+        self.urls[path] = name
+        self.files[name] = (content_type, variants)
+        return built
+
+    def __rewrite_css(self, path, css):
+        """
+        Point relative url(...) references of the CSS file at path to fingerprinted files.
+        """
+        folder = posixpath.dirname(path)
+
+        def replace(m):
+            quote, ref = m.group(1), m.group(2).strip()
+            # 跳过 data:、http: 等绝对地址和 #id
+            if re.match(r'^([a-z][a-z0-9+.-]*:|/|#)', ref, re.I):
+                return m.group(0)
+            # 保留 ?v=4.2.0 和 #iefix 等后缀
+            target, suffix = re.match(r'([^?#]*)(.*)', ref).groups()
+            name = self.urls.get(posixpath.normpath(posixpath.join(folder, target)))
+            if name is None:
+                return m.group(0)
+            return 'url(%s%s%s%s)' % (quote, posixpath.relpath(name, folder or '.'), suffix, quote)
+
+        return _RE_CSS_URL.sub(replace, css)
+
+    def url(self, path, prefix='/assets/'):
+        """
+        URL of the fingerprinted file of path, e.g. static_url('css/uikit.almost-flat.min.css') in templates.
+        Falls back to /static/ for files added after the build.
+        """
+        path = path.lstrip('/')
+        name = self.urls.get(path)
+        return '/static/' + path if name is None else prefix + name
+
+    def choose(self, name, accept_encoding):
+        """
+        :return: (content type, encoding or None, file path), None if name is not built
+        """
+        entry = self.files.get(name)
+        if entry is None:
+            return None
+        content_type, variants = entry
+        # 按 q 值协商，只考虑已生成的压缩版本
+        encoding = compression.negotiate(accept_encoding, [e for e in ('br', 'gzip') if e in variants])
+        return content_type, encoding, variants[encoding or 'identity']
+
+    async def handle(self, request):
+        found = self.choose(request.match_info['path'], request.headers.get(hdrs.ACCEPT_ENCODING, ''))
+        if found is None:
+            raise web.HTTPNotFound()
+        content_type, encoding, path = found
+        headers = {hdrs.CONTENT_TYPE: content_type, hdrs.CACHE_CONTROL: IMMUTABLE}
+        if compressible(content_type):
+            headers[hdrs.VARY] = hdrs.ACCEPT_ENCODING
+        if encoding is not None:
+            headers[hdrs.CONTENT_ENCODING] = encoding
+        # FileResponse 通过 sendfile 发送文件
+        return web.FileResponse(path, headers=headers)
+
+    def add_route(self, app, prefix='/assets/'):
+        app.router.add_get(prefix + '{path:.+}', self.handle)
+        logger.info('Add assets %s => %s', prefix, self.dest)
+
+
+def default_dest():
+    return os.path.join(tempfile.gettempdir(), 'awesome-assets')
+
+
+def static_dir():
+    # /www/static
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+
+
+if __name__ == '__main__':
+    from config import configs
+
+    logging.basicConfig(level=logging.INFO)
+    Assets(static_dir(), configs.assets.build_dir or default_dest(),
+           configs.assets.gzip_level, configs.assets.brotli_quality).build()
@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+# @author xian_wen
+# @date 10/18/2026 2:20 PM
+
+"""
+Micro-benchmarks which need no database.
+
+Usage:
+    python bench.py              # run all benchmarks
+    python bench.py handler      # run the named benchmarks only
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from aiohttp.test_utils import make_mocked_request
+
+
+def report(name, n, seconds):
+    print('%-40s %10.2f us/op' % (name, seconds * 1e6 / n))
+
+
+async def monitor_loop_lag(lags, interval=0.005):
+    """
+    Append how late the event loop wakes up from each sleep of interval seconds to lags, until cancelled.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(loop.time() - start - interval)
+
+
+def stub_route(fn):
+    """
+    Make a route with the same signature as fn but doing no work.
+    """
+
+    async def stub(*args, **kwargs):
+        return None
+
+    stub.__wrapped__ = fn
+    stub.__name__ = fn.__name__
+    stub.__method__ = fn.__method__
+    stub.__route__ = fn.__route__
+    return stub
+
+
+class LegacyRequestHandler(object):
+    """
+    RequestHandler.__call__ as it was before the binders were precompiled, inspecting the request on every call.
+    """
+
+    def __init__(self, app, fn):
+        from coroweb import (get_named_kwargs, get_required_kwargs, has_named_kwarg, has_request_arg,
+                             has_var_kwarg)
+
+        self.__func = fn
+        self.__has_request_arg = has_request_arg(fn)
+        self.__has_var_kwarg = has_var_kwarg(fn)
+        self.__has_named_kwarg = has_named_kwarg(fn)
+        self.__named_kwargs = get_named_kwargs(fn)
+        self.__required_kwargs = get_required_kwargs(fn)
+
+    async def __call__(self, request):
+        from urllib import parse
+
+        from aiohttp import web
+
+        kwargs = None
+        if self.__has_var_kwarg or self.__has_named_kwarg or self.__required_kwargs:
+            if request.method == 'POST':
+                if not request.content_type:
+                    return web.HTTPBadRequest(text='Missing Content-Type.')
+                ct = request.content_type.lower()
+                if ct.startswith('application/json'):
+                    params = await request.json()
+                    if not isinstance(params, dict):
+                        return web.HTTPBadRequest(text='JSON body must be dict object.')
+                    kwargs = params
+                elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
+                    params = await request.post()
+                    kwargs = dict(**params)
+                else:
+                    return web.HTTPBadRequest(text='Unsupported Content-Type: %s' % request.content_type)
+            if request.method == 'GET':
+                qs = request.query_string
+                if qs:
+                    kwargs = dict()
+                    for k, v in parse.parse_qs(qs, True).items():
+                        kwargs[k] = v[0]
+        if kwargs is None:
+            kwargs = dict(**request.match_info)
+        else:
+            if not self.__has_var_kwarg and self.__named_kwargs:
+                copy = dict()
+                for name in self.__named_kwargs:
+                    if name in kwargs:
+                        copy[name] = kwargs[name]
+                kwargs = copy
+            for k, v in request.match_info.items():
+                if k in kwargs:
+                    logging.warning('Duplicate arg name in named kwargs and kwargs: %s' % k)
+                kwargs[k] = v
+        if self.__has_request_arg:
+            kwargs['request'] = request
+        if self.__required_kwargs:
+            for name in self.__required_kwargs:
+                if name not in kwargs:
+                    return web.HTTPBadRequest(text='Missing argument: %s' % name)
+        logging.info('Call with kwargs: %s' % str(kwargs))
+        return await self.__func(**kwargs)
+
+
+async def bench_handler(n=2000):
+    """
+    Per-request overhead of binding args for the routes in handlers.py, the legacy handler vs RequestHandler.
+    """
+    import handlers
+    from coroweb import RequestHandler
+
+    json_headers = {'Content-Type': 'application/json'}
+    cases = [
+        (handlers.index, 'GET', '/', None),
+        (handlers.register, 'GET', '/register', None),
+        (handlers.signin, 'GET', '/signin?next=/', None),
+        (handlers.authenticate, 'POST', '/api/authenticate',
+         dict(email='admin@example.com', password='1234567890')),
+        (handlers.api_register_users, 'POST', '/api/users',
+         dict(email='admin@example.com', name='Administrator', password='1234567890')),
+    ]
+    for fn, method, path, data in cases:
+        body = json.dumps(data).encode('utf-8') if data is not None else None
+        for name, handler_cls in (('legacy', LegacyRequestHandler), ('handler', RequestHandler)):
+            handler = handler_cls(None, stub_route(fn))
+            # RequestHandler 在 request 中缓存请求体，每种 handler 使用新的 request
+            requests = []
+            for i in range(n):
+                request = make_mocked_request(method, path, headers=json_headers if body else None)
+                if body:
+                    # 预置请求体，跳过读取网络数据
+                    request._read_bytes = body
+                requests.append(request)
+            start = time.perf_counter()
+            for request in requests:
+                await handler(request)
+            report('%s %s %s' % (name, method, path), n, time.perf_counter() - start)
+
+
+def make_blogs(n):
+    from models import Blog
+    summary = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor.'
+    return [Blog(id='%050d' % i, user_id='u%d' % i, user_name='用户%d' % i, user_image='about:blank',
+                 name='Blog %d' % i, summary=summary, content=summary * 20, created_at=time.time())
+            for i in range(n)]
+
+
+async def bench_json(n=10000, repeat=5):
+    """
+    Encode a response of n blogs, the old json.dumps path vs every available encoder backend.
+    """
+    import encoder
+
+    r = dict(blogs=make_blogs(n))
+    start = time.perf_counter()
+    for i in range(repeat):
+        json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8')
+    report('json %d blogs: json.dumps + encode' % n, repeat, time.perf_counter() - start)
+    for name in ('json', 'ujson', 'orjson'):
+        try:
+            encoder.use(name)
+        except ValueError:
+            print('json %d blogs: %s not installed' % (n, name))
+            continue
+        start = time.perf_counter()
+        for i in range(repeat):
+            encoder.dumps(r)
+        report('json %d blogs: encoder %s' % (n, name), repeat, time.perf_counter() - start)
+    encoder.use()
+
+
+async def bench_rows(n=100000):
+    """
+    Memory and construction time of n find_all rows as Model objects vs compact rows.
+    """
+    from models import Blog
+
+    rows = [dict(blog.items()) for blog in make_blogs(n)]
+    for row_cls in (Blog, Blog.__row__):
+        tracemalloc.start()
+        start = time.perf_counter()
+        objs = [row_cls(**row) for row in rows]
+        seconds = time.perf_counter() - start
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        report('rows %d x %s' % (n, row_cls.__name__), n, seconds)
+        print('%-40s %10.2f MB' % ('rows %d x %s memory' % (n, row_cls.__name__), size / 1e6))
+        del objs
+
+
+def legacy_insert_args(obj):
+    """
+    Args of INSERT built the way Model.save did before __insert_args__.
+    """
+
+    def get_value_or_default(key):
+        value = getattr(obj, key, None)
+        if value is None:
+            field = obj.__mappings__[key]
+            if field.default is not None:
+                value = field.default() if callable(field.default) else field.default
+                logging.debug('Using default value for %s: %s' % (key, str(value)))
+                setattr(obj, key, value)
+        return value
+
+    args = list(map(get_value_or_default, obj.__fields__))
+    args.append(get_value_or_default(obj.__primary_key__))
+    return args
+
+
+async def bench_save_args(n=100000):
+    """
+    Build INSERT args of n new blogs with only some fields set, as in bulk saves.
+    """
+    from models import Blog
+
+    for name, build in (('legacy get_value_or_default', legacy_insert_args),
+                        ('__insert_args__', Blog.__insert_args__)):
+        blogs = [Blog(user_id='u%d' % i, name='Blog %d' % i, summary='summary', content='content')
+                 for i in range(n)]
+        start = time.perf_counter()
+        for blog in blogs:
+            build(blog)
+        report('save args %d x %s' % (n, name), n, time.perf_counter() - start)
+
+
+async def bench_logging(n=3000, concurrency=50):
+    """
+    Requests/sec of a route writing one request line and a few module lines per request,
+    with logging off, a synchronous file handler, and the queue handler of logs.init_logging.
+    """
+    from aiohttp import ClientSession, web
+    from aiohttp.test_utils import TestServer
+
+    import logs
+
+    request_logger = logging.getLogger('app.request')
+    module_logger = logging.getLogger('orm')
+
+    @web.middleware
+    async def log(request, handler):
+        start = time.perf_counter()
+        r = await handler(request)
+        ms = (time.perf_counter() - start) * 1000
+        request_logger.info('%s %s %s %.1fms', request.method, request.path, r.status, ms,
+                            extra=dict(method=request.method, path=request.path, status=r.status, ms=ms))
+        return r
+
+    async def index(request):
+        for i in range(3):
+            module_logger.info('SQL (%.1f ms, %s rows): %s args: %r', 0.5, 10, 'select * from blogs', [i])
+        module_logger.debug('Call with kwargs: %s', dict(request.query))
+        return web.Response(text='ok')
+
+    class SlowHandler(logging.Handler):
+        # 模拟磁盘或管道阻塞，每条记录写 0.2 ms
+        def __init__(self, handler):
+            super().__init__()
+            self.handler = handler
+
+        def emit(self, record):
+            time.sleep(0.0002)
+            self.handler.emit(record)
+
+        def close(self):
+            self.handler.close()
+            super().close()
+
+    class Sync(object):
+        # 旧的 basicConfig 方式，在事件循环里直接写
+        def __init__(self, handler):
+            root = logging.getLogger()
+            root.handlers.clear()
+            root.addHandler(handler)
+            root.setLevel(logging.INFO)
+            for name in ('app.request', 'orm'):
+                logging.getLogger(name).filters.clear()
+                logging.getLogger(name).setLevel(logging.NOTSET)
+            self.handler = handler
+
+        def stop(self):
+            logging.getLogger().removeHandler(self.handler)
+            self.handler.close()
+
+    class Queue(object):
+        def __init__(self, **kwargs):
+            logs.init_logging(**kwargs)
+
+        def stop(self):
+            logs.stop_logging()
+
+    app = web.Application(middlewares=[log])
+    app.router.add_get('/', index)
+    server = TestServer(app)
+    await server.start_server()
+    url = str(server.make_url('/'))
+    fd, path = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+    setups = [
+        ('off', lambda: Queue(level='WARNING', path=path)),
+        ('sync file', lambda: Sync(logs.make_handler(path=path))),
+        ('queue file', lambda: Queue(path=path)),
+        ('queue file json', lambda: Queue(path=path, format='json')),
+        ('sync slow disk', lambda: Sync(SlowHandler(logs.make_handler(path=path)))),
+        ('queue slow disk', lambda: Queue(handler=SlowHandler(logs.make_handler(path=path)))),
+        ('queue slow disk, orm=WARNING', lambda: Queue(
+            levels=dict(orm='WARNING'), handler=SlowHandler(logs.make_handler(path=path)))),
+        ('queue slow disk, sample_rate=0.1', lambda: Queue(
+            levels=dict(orm='WARNING'), sample_rate=0.1, handler=SlowHandler(logs.make_handler(path=path)))),
+    ]
+    try:
+        async with ClientSession() as session:
+            async def worker(count):
+                for i in range(count):
+                    async with session.get(url) as resp:
+                        await resp.read()
+
+            for name, setup in setups:
+                start = time.perf_counter()
+                listener = setup()
+                await asyncio.gather(*(worker(n // concurrency) for i in range(concurrency)))
+                seconds = time.perf_counter() - start
+                # 不计写完队列中剩余记录的时间，空闲时写日志的线程会追上
+                listener.stop()
+                print('%-40s %10.0f req/s' % ('logging %s' % name, n // concurrency * concurrency / seconds))
+    finally:
+        await server.close()
+        logging.getLogger().handlers.clear()
+        os.remove(path)
+
+
+async def bench_passwords(n=16, iterations=600000):
+    """
+    Throughput of n concurrent sign-ins verifying PBKDF2 passwords, and the longest event loop stall meanwhile,
+    hashing on the event loop vs in a thread pool vs in a process pool.
+    """
+    import passwords
+
+    for executor in (None, 'thread', 'process'):
+        passwords.configure(iterations=iterations, executor=executor)
+        encoded = await passwords.hash_password('password')
+        # 预热进程池
+        await passwords.verify_password('password', encoded, 'uid')
+        lags = []
+        task = asyncio.ensure_future(monitor_loop_lag(lags))
+        await asyncio.sleep(0)
+        start = time.perf_counter()
+        results = await asyncio.gather(*(passwords.verify_password('password', encoded, 'uid') for i in range(n)))
+        seconds = time.perf_counter() - start
+        task.cancel()
+        assert all(ok for ok, _ in results)
+        name = 'passwords %d sign-ins, %s' % (n, executor or 'inline')
+        print('%-40s %10.2f logins/s %8.1f ms max loop lag' % (name, n / seconds, max(lags or [seconds]) * 1000))
+    passwords.configure()
+    print('%-40s %10d CPUs' % ('passwords', os.cpu_count()))
+
+
+async def bench_compression(n=2000, repeat=20):
+    """
+    Size and time of compressing a JSON response of n blogs, and the event loop stall while compressing it
+    inline vs in the executor.
+    """
+    import compression
+    import encoder
+
+    body = encoder.dumps(dict(blogs=make_blogs(n)))
+    for encoding in compression.available():
+        start = time.perf_counter()
+        for i in range(repeat):
+            data = compression.compress_sync(body, encoding)
+        report('compress %d KB json %s -> %d KB' % (len(body) // 1024, encoding, len(data) // 1024),
+               repeat, time.perf_counter() - start)
+    for name, executor_size in (('inline', len(body) + 1), ('executor', 0)):
+        compression.configure(executor_size=executor_size)
+        lags = []
+        task = asyncio.ensure_future(monitor_loop_lag(lags, 0.001))
+        await asyncio.sleep(0.01)
+        for i in range(repeat):
+            await compression.compress(body, 'gzip')
+            # 每次压缩属于不同的请求，之间让出事件循环
+            await asyncio.sleep(0)
+        # 让 monitor_loop_lag 记录最后一次延迟
+        await asyncio.sleep(0.01)
+        task.cancel()
+        print('%-40s %10.1f ms max loop lag' % ('compress %d x gzip %s' % (repeat, name), max(lags) * 1000))
+    compression.configure()
+
+
+async def bench_rate_limit(n=10000):
+    """
+    Cost of reading the rate limit key and taking a token, and a check that a POST key comes from the body only.
+    """
+    import ratelimit
+
+    body = json.dumps(dict(email='victim@example.com', password='1234567890')).encode('utf-8')
+    requests = []
+    for i in range(n):
+        # query 中的 email 不能改变所用的桶
+        request = make_mocked_request('POST', '/api/authenticate?email=r%d' % i,
+                                      headers={'Content-Type': 'application/json'})
+        request._read_bytes = body
+        requests.append(request)
+    ratelimit.use(ratelimit.MemoryBackend())
+    allowed = 0
+    start = time.perf_counter()
+    for request in requests:
+        value = await ratelimit.limit_value(request, 'email')
+        ok, _ = await ratelimit.take('/api/authenticate:email:%s' % value, 5, 60)
+        allowed += ok
+    report('rate limit POST email', n, time.perf_counter() - start)
+    assert value == 'victim@example.com' and allowed == 5, (value, allowed)
+    ratelimit.use(ratelimit.MemoryBackend())
+
+
+BENCHMARKS = dict(
+    handler=bench_handler,
+    json=bench_json,
+    rows=bench_rows,
+    save_args=bench_save_args,
+    logging=bench_logging,
+    passwords=bench_passwords,
+    compression=bench_compression,
+    rate_limit=bench_rate_limit,
+)
+
+
+def main(names):
+    for name in names or BENCHMARKS.keys():
+        asyncio.run(BENCHMARKS[name]())
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# @author xian_wen
+# @date 10/18/2026 9:12 AM
+
+import hashlib
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    In-process LRU cache whose entries expire after their own TTL.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        # 默认有效期，单位秒，None 表示永不过期
+        self.ttl = ttl
+        self.__data = OrderedDict()
+
+    def __len__(self):
+        return len(self.__data)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        try:
+            value, expires = self.__data[key]
+        except KeyError:
+            return default
+        if expires is not None and expires <= time.time():
+            del self.__data[key]
+            return default
+        # 最近使用的移到末尾
+        self.__data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        if self.maxsize <= 0:
+            return
+        if ttl is None:
+            ttl = self.ttl
+        elif self.ttl is not None:
+            ttl = min(ttl, self.ttl)
+        if ttl is not None and ttl <= 0:
+            self.__data.pop(key, None)
+            return
+        expires = time.time() + ttl if ttl is not None else None
+        self.__data[key] = (value, expires)
+        self.__data.move_to_end(key)
+        # 淘汰最久未使用的记录
+        while len(self.__data) > self.maxsize:
+            self.__data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        value = self.__data.pop(key, None)
+        return default if value is None else value[0]
+
+    def discard_if(self, predicate):
+        """
+        Remove all entries whose (key, value) matches predicate.
+
+        :param predicate: function(key, value) -> bool
+        :return: number of removed entries
+        """
+        keys = [k for k, (v, _) in self.__data.items() if predicate(k, v)]
+        for k in keys:
+            del self.__data[k]
+        return len(keys)
+
+    def clear(self):
+        self.__data.clear()
+
+
+class CachedResponse(object):
+    """
+    Rendered response body with its validators ETag and Last-Modified.
+    """
+
+    def __init__(self, body, content_type):
+        self.body = body
+        self.content_type = content_type
+        self.etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        # HTTP 日期精确到秒
+        self.last_modified = int(time.time())
+        # Content-Encoding => 压缩后的 body，与未压缩的 body 一起淘汰
+        self.encoded = dict()
+
+    def not_modified(self, if_none_match=None, if_modified_since=None):
+        """
+        Check conditional request headers, If-None-Match takes precedence over If-Modified-Since.
+
+        :param if_none_match: raw If-None-Match header
+        :param if_modified_since: If-Modified-Since as timestamp
+        :return: True if 304 Not Modified should be sent
+        """
+        if if_none_match is not None:
+            tags = [t.strip() for t in if_none_match.split(',')]
+            return '*' in tags or self.etag in tags or ('W/' + self.etag) in tags
+        if if_modified_since is not None:
+            return self.last_modified <= if_modified_since
+        return False
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# @author xian_wen
+# @date 10/19/2026 11:30 AM
+
+"""
+Content-Encoding negotiation and compression of response bodies, large bodies are compressed in an executor.
+
+Usage:
+    encoding = compression.negotiate(request.headers.get('Accept-Encoding', ''))
+    if encoding:
+        body = await compression.compress(body, encoding)
+"""
+
+import asyncio
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 动态内容的压缩级别，比静态资源低以节省 CPU
+_options = dict(gzip_level=6, brotli_quality=5, executor_size=65536)
+
+
+def configure(gzip_level=6, brotli_quality=5, executor_size=65536):
+    """
+    :param executor_size: bodies of at least this many bytes are compressed in the default executor
+    """
+    _options.update(gzip_level=gzip_level, brotli_quality=brotli_quality, executor_size=executor_size)
+
+
+def available():
+    # 按优先级排列
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def negotiate(accept_encoding, encodings=None):
+    """
+    Choose the best encoding acceptable to the client.
+
+    :param accept_encoding: raw Accept-Encoding header, e.g. 'gzip, deflate, br;q=0.9'
+    :param encodings: candidates by priority, e.g. the precompressed variants of a file, None for available()
+    :return: 'br', 'gzip' or None
+    """
+    if not accept_encoding:
+        return None
+    q = dict()
+    for item in accept_encoding.lower().split(','):
+        name, _, params = item.partition(';')
+        value = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                value = float(params[2:])
+            except ValueError:
+                value = 0.0
+        q[name.strip()] = value
+    best = None
+    for encoding in available() if encodings is None else encodings:
+        value = q.get(encoding, q.get('*', 0.0))
+        if value > 0 and (best is None or value > best[1]):
+            best = (encoding, value)
+    return best[0] if best else None
+
+
+def compress_sync(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=_options['brotli_quality'])
+    # mtime=0 使相同内容的压缩结果相同
+    return gzip.compress(data, _options['gzip_level'], mtime=0)
+
+
+async def compress(data, encoding):
+    """
+    Compress data, in the default executor if it is large so the event loop keeps serving other requests.
+    """
+    if len(data) < _options['executor_size']:
+        return compress_sync(data, encoding)
+    return await asyncio.get_running_loop().run_in_executor(None, compress_sync, data, encoding)
@@ -52,6 +52,10 @@ try:
     import config_override
 
     configs = merge(configs, config_override.configs)
+    # 日志级别可以设置任意模块，如 aiomysql、asyncio，不限于默认配置中列出的模块
+    levels = config_override.configs.get('logging', {}).get('levels')
+    if levels:
+        configs['logging']['levels'] = dict(configs['logging']['levels'], **levels)
 except ImportError:
     config_override = None
 
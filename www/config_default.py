@@ -4,14 +4,125 @@
 
 configs = {
     'debug': True,
+    'server': {
+        'host': 'localhost',
+        'port': 9000,
+        # worker 进程数，0 表示 CPU 核数，通过 python server.py 启动
+        'workers': 0,
+        # True 时每个 worker 以 SO_REUSEPORT 各自监听，由内核分配连接，否则共用主进程监听的 socket
+        'reuse_port': False,
+        # 停止或重载时等待处理中请求的最长时间（秒）
+        'shutdown_timeout': 30,
+        # 多个 worker 时 session 和页面缓存的最长有效期（秒），写入只能使本 worker 的缓存失效
+        'worker_cache_ttl': 10
+    },
     'db': {
         'host': 'localhost',
         'port': 3306,
         'user': 'root',
         'password': 'password',
-        'database': 'awesome'
+        'database': 'awesome',
+        # 连接池大小，多进程时 maxsize 为所有 worker 的连接总数，平均分给每个 worker，重载期间多出一个 worker 的连接
+        'minsize': 1,
+        'maxsize': 10,
+        # 等待空闲连接的最长时间（秒），None 表示一直等待
+        'acquire_timeout': 10,
+        # 连接最长使用时间（秒），-1 表示不回收，应小于 MySQL 的 wait_timeout
+        'pool_recycle': 3600,
+        # 取出连接时先 ping，断开则重连
+        'pre_ping': False,
+        # 只读副本，每项覆盖上面的连接参数，如 {'host': '10.0.0.2'}
+        'replicas': [],
+        # 选择副本的策略：round_robin 或 least_loaded
+        'replica_strategy': 'round_robin',
+        # 客户端写入后多少秒内的读取走主库，写入时间通过 cookie 传给后续请求
+        'read_your_writes': 2
+    },
+    'profiler': {
+        # 超过该耗时（毫秒）的语句以 WARNING 记录，None 表示关闭
+        'slow_ms': 200,
+        # 按比例以 INFO 记录语句及参数
+        'sample_rate': 0.0,
+        # 是否对慢 SELECT 执行 EXPLAIN
+        'explain': False
+    },
+    'passwords': {
+        # 新密码的哈希算法：pbkdf2_sha256 或 scrypt，旧的 sha1 密码在登录时重新哈希
+        'algorithm': 'pbkdf2_sha256',
+        'iterations': 600000,
+        'scrypt_n': 16384,
+        'scrypt_r': 8,
+        'scrypt_p': 1,
+        # 在 'thread' 或 'process' 池中计算，max_workers 为 0 表示 CPU 核数
+        'executor': 'thread',
+        'max_workers': 0,
+        # 排队和计算中的哈希数上限，超出时请求等待
+        'max_pending': 64
     },
     'session': {
-        'secret': 'Awesome'
+        'secret': 'Awesome',
+        # 已验证 cookie 的缓存数量和最长有效期（秒）
+        'cache_size': 1024,
+        'cache_ttl': 300
+    },
+    'page_cache': {
+        # 匿名用户页面的缓存数量和有效期（秒），size 为 0 时关闭
+        'size': 256,
+        'ttl': 600
+    },
+    'assets': {
+        # 非 debug 模式下带指纹的静态文件及其压缩版本的目录，'' 表示系统临时目录下的 awesome-assets
+        'build_dir': '',
+        'gzip_level': 9,
+        # 安装 brotli 后同时生成 .br
+        'brotli_quality': 11
+    },
+    'compression': {
+        # 按 Accept-Encoding 压缩 HTML 和 JSON 响应，有 brotli 时优先使用 br
+        'enabled': True,
+        # 小于该字节数的 body 不压缩
+        'min_size': 1024,
+        # 不小于该字节数的 body 在线程池中压缩
+        'executor_size': 65536,
+        'gzip_level': 6,
+        'brotli_quality': 5
+    },
+    'templates': {
+        # 非 debug 模式下的模板字节码缓存目录，'' 表示使用系统临时目录
+        'bytecode_cache': '',
+        # 是否边渲染边发送页面
+        'stream': False
+    },
+    'logging': {
+        'level': 'INFO',
+        # 各模块的日志级别，覆盖配置中可以添加其他模块，如 'aiomysql': 'DEBUG'
+        'levels': {
+            'app': 'INFO',
+            'app.request': 'INFO',
+            'coroweb': 'INFO',
+            'encoder': 'INFO',
+            'handlers': 'INFO',
+            'orm': 'INFO',
+            # app.request 已记录每个请求的状态和耗时
+            'aiohttp.access': 'WARNING'
+        },
+        # 'text' 或 'json'
+        'format': 'text',
+        # 日志文件，'' 表示输出到 stderr
+        'path': '',
+        # 按比例记录每个请求的 INFO 日志，WARNING 及以上总是记录
+        'sample_rate': 1.0
+    },
+    'rate_limit': {
+        # 按 @get/@post 的 rate_limit 限制请求频率
+        'enabled': True,
+        # 每个进程内最多保留的令牌桶数量
+        'maxsize': 100000,
+        # 反向代理设置的客户端地址头，如 X-Real-IP，'' 表示使用连接地址
+        'ip_header': ''
+    },
+    'metrics': {
+        # 统计每个路由各阶段的耗时，通过 /metrics 输出
+        'enabled': False
     }
 }
@@ -8,18 +8,21 @@ import inspect
 import logging
 import os
 
-from urllib import parse
-
 from aiohttp import web
 
 from apis import APIError
 
+logger = logging.getLogger(__name__)
+
 
-def get(path):
+def get(path, *, cache=False, rate_limit=None):
     """
     Define decorator @get('/path')
 
     :param path:
+    :param cache: whether the rendered response for anonymous users can be cached
+    :param rate_limit: token buckets checked before the handler runs, as {key: (capacity, period in seconds)},
+                       key is 'ip' or an argument name, e.g. {'ip': (20, 60), 'email': (5, 300)}
     :return:
     """
 
@@ -31,16 +34,21 @@ def get(path):
 
         wrapper.__method__ = 'GET'
         wrapper.__route__ = path
+        wrapper.__cache__ = cache
+        wrapper.__rate_limit__ = rate_limit
         return wrapper
 
     return decorator
 
 
-def post(path):
+def post(path, *, cache=False, rate_limit=None):
     """
     Define decorator @post('/path')
 
     :param path:
+    :param cache: whether the rendered response for anonymous users can be cached
+    :param rate_limit: token buckets checked before the handler runs, as {key: (capacity, period in seconds)},
+                       key is 'ip' or an argument name, e.g. {'ip': (20, 60), 'email': (5, 300)}
     :return:
     """
 
@@ -52,6 +60,8 @@ def post(path):
 
         wrapper.__method__ = 'POST'
         wrapper.__route__ = path
+        wrapper.__cache__ = cache
+        wrapper.__rate_limit__ = rate_limit
         return wrapper
 
     return decorator
@@ -146,6 +156,37 @@ def has_request_arg(fn):
     return found
 
 
+async def read_post_params(request):
+    """
+    Parse the POST body once per request, middlewares may read it before the handler.
+
+    :return: dict like params
+    """
+    params = request.get('__params__')
+    if params is not None:
+        return params
+    if not request.content_type:
+        raise web.HTTPBadRequest(text='Missing Content-Type.')
+    ct = request.content_type.lower()
+    # JSON 数据格式
+    if ct.startswith('application/json'):
+        # Read request body decoded as json
+        try:
+            params = await request.json()
+        except ValueError:
+            raise web.HTTPBadRequest(text='Invalid JSON body.')
+        if not isinstance(params, dict):
+            raise web.HTTPBadRequest(text='JSON body must be dict object.')
+    # form 表单数据被编码为 key/value 格式发送到服务器（表单默认的提交数据的格式）
+    elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
+        # Read POST parameters from request body
+        params = await request.post()
+    else:
+        raise web.HTTPBadRequest(text='Unsupported Content-Type: %s' % request.content_type)
+    request['__params__'] = params
+    return params
+
+
 class RequestHandler(object):
 
     def __init__(self, app, fn):
@@ -156,60 +197,67 @@ class RequestHandler(object):
         self.__has_named_kwarg = has_named_kwarg(fn)
         self.__named_kwargs = get_named_kwargs(fn)
         self.__required_kwargs = get_required_kwargs(fn)
+        # 路由选项，供 middleware 通过 request.match_info.handler 读取
+        self.__cache__ = getattr(fn, '__cache__', False)
+        self.__rate_limit__ = getattr(fn, '__rate_limit__', None)
+        # 根据函数签名，预先选择绑定参数的方式
+        self.__read_body = None
+        if not self.__has_var_kwarg and not self.__has_named_kwarg:
+            if inspect.signature(fn).parameters:
+                self.__bind = self.__bind_match_info
+            else:
+                self.__bind = self.__bind_no_arg
+        elif getattr(fn, '__method__', None) == 'POST':
+            self.__bind = self.__bind_params
+            self.__read_body = read_post_params
+        else:
+            self.__bind = self.__bind_query
 
-    # Make RequestHandler callable
-    async def __call__(self, request):
-        kwargs = None
-        if self.__has_var_kwarg or self.__has_named_kwarg or self.__required_kwargs:
-            if request.method == 'POST':
-                if not request.content_type:
-                    return web.HTTPBadRequest(text='Missing Content-Type.')
-                ct = request.content_type.lower()
-                # JSON 数据格式
-                if ct.startswith('application/json'):
-                    # Read request body decoded as json
-                    params = await request.json()
-                    if not isinstance(params, dict):
-                        return web.HTTPBadRequest(text='JSON body must be dict object.')
-                    kwargs = params
-                # form 表单数据被编码为 key/value 格式发送到服务器（表单默认的提交数据的格式）
-                elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
-                    # Read POST parameters from request body
-                    params = await request.post()
-                    kwargs = dict(**params)
-                else:
-                    return web.HTTPBadRequest(text='Unsupported Content-Type: %s' % request.content_type)
-            if request.method == 'GET':
-                # The query string in the URL, e.g., id=10
-                qs = request.query_string
-                if qs:
-                    kwargs = dict()
-                    # {'id': ['10']}
-                    for k, v in parse.parse_qs(qs, True).items():
-                        kwargs[k] = v[0]
-        if kwargs is None:
-            kwargs = dict(**request.match_info)
+    @staticmethod
+    def __bind_no_arg(request):
+        return {}
+
+    def __bind_match_info(self, request):
+        kwargs = dict(**request.match_info)
+        if self.__has_request_arg:
+            kwargs['request'] = request
+        return kwargs
+
+    def __bind_query(self, request):
+        # The query string in the URL, e.g., id=10, parsed and cached by aiohttp
+        return self.__bind_params(request, request.query)
+
+    def __bind_params(self, request, params):
+        if self.__has_var_kwarg:
+            # 重复的 key 只取第一个值
+            kwargs = dict(params)
         else:
-            if not self.__has_var_kwarg and self.__named_kwargs:
-                # Remove all unnamed kwargs
-                copy = dict()
-                for name in self.__named_kwargs:
-                    if name in kwargs:
-                        copy[name] = kwargs[name]
-                kwargs = copy
-            # Check named kwargs
-            for k, v in request.match_info.items():
-                if k in kwargs:
-                    logging.warning('Duplicate arg name in named kwargs and kwargs: %s' % k)
-                kwargs[k] = v
+            # Remove all unnamed kwargs
+            kwargs = {name: params[name] for name in self.__named_kwargs if name in params}
+        # Check named kwargs
+        for k, v in request.match_info.items():
+            if k in kwargs:
+                logger.warning('Duplicate arg name in named kwargs and kwargs: %s', k)
+            kwargs[k] = v
         if self.__has_request_arg:
             kwargs['request'] = request
         # Check required kwargs
-        if self.__required_kwargs:
-            for name in self.__required_kwargs:
-                if name not in kwargs:
-                    return web.HTTPBadRequest(text='Missing argument: %s' % name)
-        logging.info('Call with kwargs: %s' % str(kwargs))
+        for name in self.__required_kwargs:
+            if name not in kwargs:
+                raise web.HTTPBadRequest(text='Missing argument: %s' % name)
+        return kwargs
+
+    # Make RequestHandler callable
+    async def __call__(self, request):
+        try:
+            if self.__read_body is None:
+                kwargs = self.__bind(request)
+            else:
+                kwargs = self.__bind(request, await self.__read_body(request))
+        except web.HTTPBadRequest as e:
+            return e
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Call with kwargs: %s', kwargs)
         try:
             r = await self.__func(**kwargs)
             return r
@@ -223,7 +271,7 @@ def add_static(app):
     # Add a router and a handler for returning static files
     # Development only, in production, use web servers like nginx or apache
     app.router.add_static('/static/', path)
-    logging.info('Add static %s => %s' % ('/static/', path))
+    logger.info('Add static %s => %s', '/static/', path)
 
 
 def add_route(app, fn):
@@ -233,9 +281,9 @@ def add_route(app, fn):
         raise ValueError('@get or @post not defined in %s.' % str(fn))
     # if not asyncio.iscoroutinefunction(fn) and not inspect.isgeneratorfunction(fn):
     #     fn = asyncio.coroutine(fn)
-    logging.info(
+    logger.info(
         # GET / => fn(*args, **kwargs)
-        'Add route %s %s => %s(%s)' % (method, path, fn.__name__, ', '.join(inspect.signature(fn).parameters.keys())))
+        'Add route %s %s => %s(%s)', method, path, fn.__name__, ', '.join(inspect.signature(fn).parameters.keys()))
     # Attention: handler is converted to coroutine internally when it is a regular function
     app.router.add_route(method, path, RequestHandler(app, fn))
 
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# @author xian_wen
+# @date 10/18/2026 3:05 PM
+
+"""
+JSON encoding to UTF-8 bytes, using orjson or ujson when installed and json otherwise.
+
+Usage:
+    body = encoder.dumps(dict(blogs=blogs))
+    encoder.use('json')  # force a backend
+"""
+
+import json
+import logging
+
+from apis import APIError
+
+logger = logging.getLogger(__name__)
+
+
+def default(o):
+    """
+    Convert objects unknown to the JSON backends, Model is a dict so needs no conversion.
+    """
+    if isinstance(o, APIError):
+        return dict(error=o.error, data=o.data, message=o.message)
+    if hasattr(o, '_asdict'):
+        return o._asdict()
+    if hasattr(o, '__dict__'):
+        return o.__dict__
+    raise TypeError('Object of type %s is not JSON serializable' % o.__class__.__name__)
+
+
+def _json_backend():
+    # ensure_ascii: if false then return value can contain non-ASCII characters
+    encode = json.JSONEncoder(ensure_ascii=False, default=default).encode
+
+    def dumps(obj):
+        return encode(obj).encode('utf-8')
+
+    return dumps
+
+
+def _ujson_backend():
+    import ujson
+
+    def dumps(obj):
+        return ujson.dumps(obj, ensure_ascii=False, default=default).encode('utf-8')
+
+    return dumps
+
+
+def _orjson_backend():
+    import orjson
+
+    def dumps(obj):
+        # orjson 直接输出 UTF-8 bytes
+        return orjson.dumps(obj, default=default)
+
+    return dumps
+
+
+# name => factory of dumps(obj) -> bytes，按优先级排列
+_backends = dict(orjson=_orjson_backend, ujson=_ujson_backend, json=_json_backend)
+
+backend = None
+dumps = None
+
+
+def register(name, factory):
+    """
+    Register a backend whose factory returns a function dumps(obj) -> bytes.
+    """
+    _backends[name] = factory
+
+
+def use(name=None):
+    """
+    Switch to backend name, or the first importable one if name is None.
+    """
+    global backend, dumps
+    names = [name] if name else list(_backends.keys())
+    for n in names:
+        try:
+            dumps = _backends[n]()
+        except ImportError:
+            continue
+        backend = n
+        logger.info('Use JSON encoder: %s', n)
+        return
+    raise ValueError('JSON encoder not available: %s' % name)
+
+
+use()
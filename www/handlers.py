@@ -3,22 +3,31 @@
 # @date 6/3/2021 11:37 AM
 
 import hashlib
-import json
 import logging
 import re
 import time
 
 from aiohttp import web
 
+import encoder
+import metrics
+import orm
+import passwords
+from cache import LRUCache
 from coroweb import get, post
 
 from models import Blog, User, next_id
-from apis import APIValueError, APIError
+from apis import APIValueError, APIError, APIPermissionError
 from config import configs
 
+logger = logging.getLogger(__name__)
+
 COOKIE_NAME = 'awesession'
 _COOKIE_KEY = configs.session.secret  # Awesome
 
+# cookie str => user，有效期不超过 cookie 的 expires
+_session_cache = LRUCache(configs.session.cache_size, configs.session.cache_ttl)
+
 _RE_EMAIL = re.compile(r'^[a-z0-9.-_]+@[a-z0-9-_]+(.[a-z0-9-_]+){1,4}$')
 _RE_SHA1 = re.compile(r'^[a-f0-9]{40}$')
 
@@ -51,7 +60,7 @@ def make_cookie(user):
     user.password = '******'
     r.content_type = 'application/json'
     # Serialize user to a json string, which can contain non-ASCII characters
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = encoder.dumps(user)
     return r
 
 
@@ -69,23 +78,57 @@ async def cookie2user(cookie_str):
         if len(L) != 3:
             return None
         uid, expires, sha1 = L
-        if int(expires) < time.time():
+        ttl = int(expires) - time.time()
+        if ttl < 0:
             return None
+        user = _session_cache.get(cookie_str)
+        if user is not None:
+            # 返回副本，避免 handler 修改缓存中的 user
+            return User(**user)
         user = await User.find(uid)
         if user is None:
             return None
         s = '%s-%s-%s-%s' % (uid, user.password, expires, _COOKIE_KEY)
         if sha1 != hashlib.sha1(s.encode('utf-8')).hexdigest():
-            logging.info('Invalid sha1')
+            logger.info('Invalid sha1')
             return None
+        # 复制后再隐藏密码，find 返回的对象可能在本次请求中共享
+        user = User(**user)
         user.password = '******'
+        _session_cache.set(cookie_str, User(**user), ttl)
         return user
     except Exception as e:
-        logging.exception(e)
+        logger.exception(e)
         return None
 
 
-@get('/')
+def check_admin(request):
+    if request.__user__ is None or not request.__user__.admin:
+        raise APIPermissionError()
+
+
+def configure_session_cache(ttl):
+    """
+    Limit how long a verified session is cached, e.g. when other worker processes cannot invalidate it.
+    """
+    _session_cache.ttl = ttl
+
+
+def invalidate_sessions(uid):
+    """
+    Drop all cached sessions of user, e.g. after password or admin changed.
+
+    :param uid: user id
+    :return: number of dropped sessions
+    """
+    return _session_cache.discard_if(lambda cookie_str, user: user.id == uid)
+
+
+# 用户的 password 或 admin 可能改变，使其所有 session 缓存失效
+orm.on_change(User, lambda user, action: invalidate_sessions(user.id))
+
+
+@get('/', cache=True)
 async def index(request):
     summary = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua.'
     blogs = [
@@ -99,21 +142,22 @@ async def index(request):
     }
 
 
-@get('/register')
+@get('/register', cache=True)
 async def register():
     return {
         '__template__': 'register.html'
     }
 
 
-@get('/signin')
+@get('/signin', cache=True)
 async def signin():
     return {
         '__template__': 'signin.html'
     }
 
 
-@post('/api/authenticate')
+# 每个 IP 每分钟 20 次，每个邮箱每 5 分钟 5 次
+@post('/api/authenticate', rate_limit={'ip': (20, 60), 'email': (5, 300)})
 async def authenticate(*, email, password):
     if not email:
         raise APIValueError('email', 'Invalid email.')
@@ -123,19 +167,21 @@ async def authenticate(*, email, password):
     if len(users) == 0:
         raise APIValueError('email', 'Email not exist.')
     user = users[0]
-    # Check password
-    sha1 = hashlib.sha1()
-    sha1.update(user.id.encode('utf-8'))
-    sha1.update(b':')
-    sha1.update(password.encode('utf-8'))
-    if user.password != sha1.hexdigest():
+    # Check password，在 executor 中计算哈希
+    ok, new_password = await passwords.verify_password(password, user.password, user.id)
+    if not ok:
         raise APIValueError('password', 'Invalid password.')
+    if new_password:
+        # 旧的 sha1 密码或参数已过时，改用当前算法保存
+        user.password = new_password
+        await user.update()
     # Authenticate ok, set cookie
     r = make_cookie(user)
     return r
 
 
-@post('/api/users')
+# 每个 IP 每小时注册 10 次
+@post('/api/users', rate_limit={'ip': (10, 3600)})
 async def api_register_users(*, email, name, password):
     if not name or not name.strip():
         raise APIValueError('name')
@@ -147,11 +193,36 @@ async def api_register_users(*, email, name, password):
     if len(users) > 0:
         raise APIError('Register: failed', 'email', 'Email is already in use.')
     uid = next_id()
-    sha1_password = '%s:%s' % (uid, password)
     user = User(id=uid, name=name.strip(), email=email,
-                password=hashlib.sha1(sha1_password.encode('utf-8')).hexdigest(),
+                password=await passwords.hash_password(password),
                 image='http://www.gravatar.com/avatar/%s?d=mm&s=120' % hashlib.md5(email.encode('utf-8')).hexdigest())
     await user.save()
     # Make session cookie
     r = make_cookie(user)
     return r
+
+
+@get('/api/admin/pool')
+async def api_pool_stats(request):
+    check_admin(request)
+    return orm.pool_stats()
+
+
+@get('/api/admin/queries')
+async def api_top_queries(request, *, n='10', key='total'):
+    check_admin(request)
+    if key not in ('total', 'avg', 'p99', 'max', 'calls', 'rows'):
+        raise APIValueError('key', 'Invalid key.')
+    try:
+        n = int(n)
+    except ValueError:
+        raise APIValueError('n', 'Invalid n.')
+    return dict(queries=orm.profiler.top(n, key))
+
+
+@get('/metrics')
+async def api_metrics():
+    if not configs.metrics.enabled:
+        raise web.HTTPNotFound()
+    return web.Response(body=metrics.render_prometheus().encode('utf-8'),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# @author xian_wen
+# @date 10/18/2026 7:30 PM
+
+"""
+Logging off the event loop: loggers only put records on a queue, a listener thread formats and writes them.
+
+Usage:
+    logs.init_logging(**configs.logging)
+    ...
+    logs.stop_logging()  # flush the queue, also called at exit
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+# LogRecord 自带的属性，其余属性视为 extra 字段
+_RECORD_ATTRS = frozenset(logging.makeLogRecord({}).__dict__) | {'message', 'asctime'}
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Pass a random fraction of records below WARNING, records at WARNING or above always pass.
+    """
+
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or self.rate >= 1 or random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line, with the extra fields of the record as keys.
+    """
+
+    def format(self, record):
+        r = dict(time=self.formatTime(record), level=record.levelname, logger=record.name,
+                 process=record.process, message=record.getMessage())
+        for k, v in record.__dict__.items():
+            if k not in _RECORD_ATTRS:
+                r[k] = v
+        if record.exc_info:
+            r['exc_info'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            r['exc_info'] = record.exc_text
+        return json.dumps(r, ensure_ascii=False, default=str)
+
+
+def make_handler(format='text', path=''):
+    """
+    Handler writing to path, or stderr if path is empty, in format 'text' or 'json'.
+    """
+    if path:
+        handler = logging.FileHandler(path, encoding='utf-8')
+    else:
+        handler = logging.StreamHandler(sys.stderr)
+    if format == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(process)d %(name)s: %(message)s'))
+    return handler
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record):
+        # 只在调用线程合并 msg 和 args，避免写日志的线程访问可变的参数，时间等由写日志的线程格式化
+        # root 上只有这一个 handler，无需像 QueueHandler 那样复制 record
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_exc_formatter = logging.Formatter()
+
+
+# 当前进程的 QueueListener 及其所属进程，fork 出的子进程中不存在写日志的线程
+_listener = None
+_listener_pid = None
+
+
+def init_logging(level='INFO', levels=None, format='text', path='', sample_rate=1.0, sampled=('app.request',),
+                 handler=None):
+    """
+    Route all records through a queue to a writer thread.
+
+    :param level: root level
+    :param levels: logger name => level, e.g. {'orm': 'WARNING'}
+    :param format: 'text' or 'json'
+    :param path: log file, '' for stderr
+    :param sample_rate: fraction of INFO and DEBUG records kept for the sampled loggers
+    :param sampled: names of the per-request loggers to sample
+    :param handler: handler run by the writer thread, built from format and path if None
+    :return: the started QueueListener
+    """
+    global _listener, _listener_pid
+    if _listener_pid == os.getpid():
+        stop_logging()
+    if handler is None:
+        handler = make_handler(format, path)
+    q = queue.SimpleQueue()
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(_QueueHandler(q))
+    root.setLevel(level)
+    for name, lv in (levels or {}).items():
+        logging.getLogger(name).setLevel(lv)
+    for name in sampled:
+        logger = logging.getLogger(name)
+        for f in [f for f in logger.filters if isinstance(f, SamplingFilter)]:
+            logger.removeFilter(f)
+        if sample_rate < 1:
+            logger.addFilter(SamplingFilter(sample_rate))
+    _listener = QueueListener(q, handler, respect_handler_level=True)
+    _listener.start()
+    _listener_pid = os.getpid()
+    return _listener
+
+
+def stop_logging():
+    """
+    Write out the queued records and stop the writer thread of this process.
+    """
+    global _listener, _listener_pid
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+    _listener = _listener_pid = None
+
+
+atexit.register(stop_logging)
+
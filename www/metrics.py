@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# @author xian_wen
+# @date 10/18/2026 4:40 PM
+
+import bisect
+import contextvars
+
+# 默认分桶上界，单位秒
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """
+    Fixed bucket histogram, e.g. of latencies in seconds.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # 最后一个桶为 +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        # 落入第一个上界 >= value 的桶
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """
+        Cumulative counts as [(upper bound, count)], ending with (inf, total count).
+        """
+        result = []
+        total = 0
+        for i, c in enumerate(self.counts):
+            total += c
+            result.append((self.buckets[i] if i < len(self.buckets) else float('inf'), total))
+        return result
+
+    def to_dict(self):
+        return dict(count=self.count, sum=self.sum,
+                    avg=self.sum / self.count if self.count else None,
+                    buckets=dict(('+Inf' if le == float('inf') else str(le), c) for le, c in self.cumulative()))
+
+
+# 当前请求各阶段的耗时，未开启统计时为 None
+_timings = contextvars.ContextVar('timings', default=None)
+
+# (route, phase) => Histogram
+request_histograms = dict()
+
+
+def add_time(phase, seconds):
+    """
+    Add seconds to a phase of the current request, e.g. auth, db, template, serialize.
+    Does nothing outside an instrumented request.
+    """
+    timings = _timings.get()
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0.0) + seconds
+
+
+def start_request():
+    """
+    Start collecting phase timings of the current request.
+
+    :return: token for finish_request()
+    """
+    return _timings.set(dict())
+
+
+def finish_request(token, route, seconds):
+    """
+    Record the total and phase timings of the current request under route.
+    """
+    timings = _timings.get()
+    _timings.reset(token)
+    timings['total'] = seconds
+    for phase, value in timings.items():
+        h = request_histograms.get((route, phase))
+        if h is None:
+            h = request_histograms[(route, phase)] = Histogram()
+        h.observe(value)
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_prometheus(name='awesome_request_seconds'):
+    """
+    Request histograms in Prometheus text exposition format.
+    """
+    lines = [
+        '# HELP %s Request latency by route and phase, auth includes its db time.' % name,
+        '# TYPE %s histogram' % name,
+    ]
+    for (route, phase), h in sorted(request_histograms.items()):
+        labels = 'route="%s",phase="%s"' % (_label(route), _label(phase))
+        for le, count in h.cumulative():
+            lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, '+Inf' if le == float('inf') else le, count))
+        lines.append('%s_sum{%s} %r' % (name, labels, h.sum))
+        lines.append('%s_count{%s} %d' % (name, labels, h.count))
+    return '\n'.join(lines) + '\n'
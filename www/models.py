@@ -5,7 +5,7 @@
 import time
 import uuid
 
-from orm import Model, StringField, BooleanField, FloatField, TextField
+from orm import Model, StringField, BooleanField, FloatField, TextField, prefetch_count
 
 
 def next_id():
@@ -19,7 +19,8 @@ class User(Model):
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     email = StringField(ddl='varchar(50)')
-    password = StringField(ddl='varchar(50)')
+    # 形如 pbkdf2_sha256$iterations$salt$hash，旧数据为 40 位 sha1
+    password = StringField(ddl='varchar(200)')
     admin = BooleanField()
     name = StringField(ddl='varchar(50)')
     image = StringField(ddl='varchar(500)')
@@ -49,3 +50,21 @@ class Comment(Model):
     user_image = StringField(ddl='varchar(500)')
     content = TextField()
     created_at = FloatField(default=time.time)
+
+
+async def prefetch_users(items):
+    """
+    Set item.user of blogs or comments to their authors with public fields only.
+    """
+    users = await User.find_by_ids(item.user_id for item in items)
+    for item in items:
+        user = users.get(item.user_id)
+        item.user = None if user is None else User(id=user.id, name=user.name, image=user.image)
+    return items
+
+
+async def prefetch_comment_counts(blogs):
+    """
+    Set blog.comment_count of blogs.
+    """
+    return await prefetch_count(blogs, Comment, 'blog_id', 'comment_count')
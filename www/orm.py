@@ -2,18 +2,159 @@
 # @author xian_wen
 # @date 5/26/2021 3:39 PM
 
+import asyncio
+import base64
+import collections
+import contextvars
+import functools
+import json
 import logging
+import random
+import time
+from contextlib import asynccontextmanager, contextmanager
+
 import aiomysql
 
+from metrics import Histogram, add_time
 
-def log(sql, args=()):
-    logging.info('SQL: %s' % sql)
+logger = logging.getLogger(__name__)
 
 
-async def create_pool(**kwargs):
-    logging.info('Create a database connection pool...')
-    global __pool
-    __pool = await aiomysql.create_pool(
+class PoolMetrics(object):
+    """
+    Live metrics of the connection pool.
+    """
+
+    def __init__(self):
+        self.waiters = 0
+        self.acquire_timeouts = 0
+        self.acquire_wait = Histogram()
+
+
+class QueryStats(object):
+    """
+    Counters of one statement shape, i.e. the SQL with ? placeholders.
+    """
+
+    # 计算 p99 时保留的最近耗时数量
+    SAMPLES = 1000
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.latency = Histogram()
+        self.samples = collections.deque(maxlen=self.SAMPLES)
+        self.explain = None
+
+    def observe(self, seconds, rows):
+        self.calls += 1
+        self.total += seconds
+        self.rows += rows
+        if seconds > self.max:
+            self.max = seconds
+        self.latency.observe(seconds)
+        self.samples.append(seconds)
+
+    def percentile(self, q):
+        if not self.samples:
+            return None
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def to_dict(self):
+        return dict(sql=self.sql, calls=self.calls, total=self.total,
+                    avg=self.total / self.calls if self.calls else None, p99=self.percentile(0.99),
+                    max=self.max, rows=self.rows, latency=self.latency.to_dict(), explain=self.explain)
+
+
+class QueryProfiler(object):
+    """
+    Per statement shape counters, slow query log and sampled query log.
+    """
+
+    # 最多记录的语句种类，超出的计入 OTHER
+    MAX_SHAPES = 500
+    OTHER = 'OTHER'
+
+    def __init__(self):
+        self.slow_ms = 200
+        self.sample_rate = 0.0
+        self.explain = False
+        self.queries = dict()
+
+    def configure(self, slow_ms=200, sample_rate=0.0, explain=False):
+        """
+        :param slow_ms: statements taking longer are logged at WARNING with args, None to disable
+        :param sample_rate: fraction of all statements logged at INFO with args
+        :param explain: whether to capture EXPLAIN of the first slow run of each SELECT shape
+        """
+        self.slow_ms = slow_ms
+        self.sample_rate = sample_rate
+        self.explain = explain
+
+    def observe(self, sql, args, seconds, rows):
+        # 计入当前请求的 db 耗时
+        add_time('db', seconds)
+        stats = self.queries.get(sql)
+        if stats is None:
+            key = sql if len(self.queries) < self.MAX_SHAPES else self.OTHER
+            stats = self.queries.get(key)
+            if stats is None:
+                stats = self.queries[key] = QueryStats(key)
+        stats.observe(seconds, rows)
+        if self.slow_ms is not None and seconds * 1000 >= self.slow_ms:
+            logger.warning('Slow SQL (%.1f ms, %s rows): %s args: %r', seconds * 1000, rows, sql, args)
+            if self.explain and stats.explain is None and sql.lstrip()[:6].upper() == 'SELECT':
+                # 每种语句只 EXPLAIN 一次，不阻塞当前请求
+                stats.explain = []
+                asyncio.ensure_future(self.capture_explain(stats, sql, args))
+        elif self.sample_rate and random.random() < self.sample_rate:
+            logger.info('SQL (%.1f ms, %s rows): %s args: %r', seconds * 1000, rows, sql, args)
+
+    @staticmethod
+    async def capture_explain(stats, sql, args):
+        # 任务复制了调用方的上下文，不能使用其事务固定的连接，另从连接池获取
+        _transaction.set(None)
+        try:
+            stats.explain = await select('EXPLAIN ' + sql, args)
+        except Exception as e:
+            logger.warning('Failed to EXPLAIN %s: %s', sql, e)
+
+    def top(self, n=10, key='total'):
+        """
+        The n statement shapes with the largest key, one of total, avg, p99, max, calls and rows.
+        """
+        stats = [s.to_dict() for s in self.queries.values()]
+        stats.sort(key=lambda d: d[key] or 0, reverse=True)
+        return stats[:n]
+
+    def log_top(self, n=10, key='total'):
+        for d in self.top(n, key):
+            logger.warning('Top SQL: calls=%s total=%.3fs avg=%.1fms p99=%.1fms rows=%s: %s',
+                            d['calls'], d['total'], d['avg'] * 1000, d['p99'] * 1000, d['rows'], d['sql'])
+
+
+profiler = QueryProfiler()
+pool_metrics = PoolMetrics()
+
+# 连接池选项，由 create_pool 设置
+_acquire_timeout = None
+_pre_ping = False
+# 只读副本的连接池，选择策略和写后读主库的时间窗口（秒）
+_replicas = []
+_replica_strategy = 'round_robin'
+_read_your_writes = 0
+_next_replica = 0
+
+# 当前客户端最后一次写入，由 read_your_writes() 设置
+_last_write = contextvars.ContextVar('last_write', default=None)
+
+
+async def _create_pool(**kwargs):
+    return await aiomysql.create_pool(
         host=kwargs.get('host', 'localhost'),
         port=kwargs.get('port', 3306),
         user=kwargs['user'],
@@ -23,42 +164,514 @@ async def create_pool(**kwargs):
         autocommit=kwargs.get('autocommit', True),
         maxsize=kwargs.get('maxsize', 10),
         minsize=kwargs.get('minsize', 1),
+        # 连接超过 pool_recycle 秒后重建，应小于 MySQL 的 wait_timeout
+        pool_recycle=kwargs.get('pool_recycle', -1),
+        connect_timeout=kwargs.get('connect_timeout', 60),
+    )
+
+
+async def create_pool(**kwargs):
+    """
+    Create the primary pool and one pool per replica.
+
+    :param kwargs: connection and pool options, replicas is a list of dicts overriding
+                   them for each read replica, e.g. [dict(host='10.0.0.2')]
+    :return:
+    """
+    logger.info('Create a database connection pool...')
+    global __pool, _acquire_timeout, _pre_ping, _replicas, _replica_strategy, _read_your_writes
+    _acquire_timeout = kwargs.get('acquire_timeout', None)
+    _pre_ping = kwargs.get('pre_ping', False)
+    _replica_strategy = kwargs.get('replica_strategy', 'round_robin')
+    _read_your_writes = kwargs.get('read_your_writes', 0)
+    __pool = await _create_pool(**kwargs)
+    replicas = []
+    for replica in kwargs.get('replicas', None) or ():
+        logger.info('Create a replica connection pool: %s', replica.get('host'))
+        options = dict(kwargs)
+        options.update(replica)
+        replicas.append(await _create_pool(**options))
+    _replicas = replicas
+
+
+async def close_pool():
+    """
+    Close the primary and replica pools after their connections are released.
+    """
+    global __pool, _replicas
+    pools = [p for p in [globals().get('__pool')] + _replicas if p is not None]
+    __pool = None
+    _replicas = []
+    for pool in pools:
+        pool.close()
+    for pool in pools:
+        await pool.wait_closed()
+
+
+def _choose_replica():
+    global _next_replica
+    if _replica_strategy == 'least_loaded':
+        # 使用中连接最少的副本
+        return min(_replicas, key=lambda p: p.size - p.freesize)
+    _next_replica = (_next_replica + 1) % len(_replicas)
+    return _replicas[_next_replica]
+
+
+class LastWrite(object):
+    """
+    Time of the last write of one client, carried between its requests by the caller, e.g. in a cookie.
+    """
+
+    def __init__(self, at=None):
+        self.at = at
+        self.changed = False
+
+
+@contextmanager
+def read_your_writes(last_write=None):
+    """
+    Within the block, reads go to the primary until read_your_writes seconds after the client's last write,
+    whether it was made inside the block or by an earlier request passed in as last_write.
+    Outside any block, writes are not tracked and reads always go to a replica.
+
+    Usage:
+        with orm.read_your_writes(float(request.cookies['last_write'])) as w:
+            r = await handler(request)
+        if w.changed:
+            r.set_cookie('last_write', str(w.at))
+
+    :param last_write: time.time() of the client's last write, None if unknown
+    """
+    w = LastWrite(last_write)
+    token = _last_write.set(w)
+    try:
+        yield w
+    finally:
+        _last_write.reset(token)
+
+
+def _mark_write():
+    w = _last_write.get()
+    if w is not None:
+        # 记录在可变对象上，gather 创建的子任务中的写入也能被请求看到
+        w.at = time.time()
+        w.changed = True
+
+
+def _read_pool():
+    """
+    Choose the pool for a read outside transaction, the primary if no replica is configured
+    or the current client wrote within the read-your-writes window.
+    """
+    if not _replicas:
+        return __pool
+    w = _last_write.get()
+    if w is not None and w.at is not None and time.time() - w.at < _read_your_writes:
+        return __pool
+    return _choose_replica()
+
+
+async def _acquire_conn(pool):
+    pool_metrics.waiters += 1
+    start = time.perf_counter()
+    try:
+        conn = await asyncio.wait_for(pool.acquire(), _acquire_timeout)
+    except asyncio.TimeoutError:
+        pool_metrics.acquire_timeouts += 1
+        raise
+    finally:
+        pool_metrics.waiters -= 1
+        pool_metrics.acquire_wait.observe(time.perf_counter() - start)
+    if _pre_ping:
+        try:
+            # 检查连接是否可用，断开则重连
+            await conn.ping(reconnect=True)
+        except BaseException:
+            pool.release(conn)
+            raise
+    return conn
+
+
+def _pool_info(pool):
+    return dict(minsize=pool.minsize, maxsize=pool.maxsize, size=pool.size,
+                in_use=pool.size - pool.freesize, idle=pool.freesize)
+
+
+def pool_stats():
+    """
+    Snapshot of pool size, usage, acquire wait times and statement latencies.
+    """
+    stats = dict(
+        waiters=pool_metrics.waiters,
+        acquire_timeouts=pool_metrics.acquire_timeouts,
+        acquire_wait=pool_metrics.acquire_wait.to_dict(),
+        queries=profiler.top(len(profiler.queries)),
+        sql_cache=sql_cache_info(),
     )
+    pool = globals().get('__pool')
+    if pool is not None:
+        stats.update(_pool_info(pool))
+        stats.update(replicas=[_pool_info(p) for p in _replicas])
+    return stats
+
+
+@functools.lru_cache(maxsize=1024)
+def translate(sql):
+    """
+    Translate ? placeholders into %s used by aiomysql, cached by SQL string.
+    """
+    return sql.replace('?', '%s')
+
+
+def select_columns(columns, names):
+    """
+    SELECT list of attribute names, aliasing columns whose name differs.
+
+    :param columns: attribute name => column name
+    :param names:
+    :return:
+    """
+    return ', '.join(map(lambda f: columns[f] if columns[f] == f else '%s AS %s' % (columns[f], f), names))
+
+
+@functools.lru_cache(maxsize=1024)
+def build_select_sql(model, where, order_by, limit, fields=None):
+    """
+    Build SELECT statement once per query shape.
+
+    :param model: Model subclass
+    :param where: WHERE clause or None
+    :param order_by: ORDER BY clause or None
+    :param limit: number of LIMIT placeholders, None, 1 or 2
+    :param fields: tuple of attribute names to select, None for all
+    :return:
+    """
+    if fields is None:
+        sql = [model.__select__]
+    else:
+        sql = ['SELECT %s FROM %s' % (select_columns(model.__columns__, fields), model.__table__)]
+    if where:
+        sql.append('WHERE')
+        sql.append(where)
+    if order_by:
+        sql.append('ORDER BY')
+        sql.append(order_by)
+    if limit:
+        sql.append('LIMIT')
+        sql.append(create_args_string(limit))
+    return ' '.join(sql)
+
+
+@functools.lru_cache(maxsize=256)
+def build_number_sql(model, select_field, where):
+    sql = 'SELECT %s _num_ FROM %s' % (select_field, model.__table__)
+    if where:
+        sql = '%s WHERE %s' % (sql, where)
+    return sql
+
+
+def sql_cache_info():
+    """
+    Hits, misses and sizes of the SQL caches.
+    """
+    return dict((f.__name__, f.cache_info()._asdict()) for f in (translate, build_select_sql, build_number_sql))
+
+
+class Transaction(object):
+    """
+    The connection pinned by transaction() and the current savepoint depth.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.depth = 0
+
+
+# 当前协程所在事务，事务内的所有语句使用同一个连接
+_transaction = contextvars.ContextVar('transaction', default=None)
+
+
+@asynccontextmanager
+async def acquire(readonly=False):
+    """
+    Yield the connection pinned by the current transaction, or acquire one from pool.
+
+    :param readonly: whether the connection may come from a read replica
+    """
+    tx = _transaction.get()
+    if tx is not None:
+        yield tx.conn
+    else:
+        pool = _read_pool() if readonly else __pool
+        conn = await _acquire_conn(pool)
+        try:
+            yield conn
+        finally:
+            pool.release(conn)
 
 
-# SELECT
+@asynccontextmanager
+async def transaction():
+    """
+    Run all statements inside the block on one connection, commit on success and
+    rollback on exception. Nested blocks use SAVEPOINT.
+
+    Usage:
+        async with orm.transaction():
+            await user.save()
+            await blog.save()
+
+    Statements inside the block share one connection, so do not run them concurrently,
+    e.g. with asyncio.gather().
+    """
+    tx = _transaction.get()
+    if tx is not None:
+        tx.depth += 1
+        savepoint = 'sp_%d' % tx.depth
+        try:
+            async with tx.conn.cursor() as cur:
+                await cur.execute('SAVEPOINT %s' % savepoint)
+                try:
+                    yield tx.conn
+                except BaseException:
+                    await cur.execute('ROLLBACK TO SAVEPOINT %s' % savepoint)
+                    raise
+                await cur.execute('RELEASE SAVEPOINT %s' % savepoint)
+        finally:
+            tx.depth -= 1
+        return
+    async with acquire() as conn:
+        await conn.begin()
+        token = _transaction.set(Transaction(conn))
+        try:
+            yield conn
+        except BaseException:
+            await conn.rollback()
+            raise
+        else:
+            await conn.commit()
+        finally:
+            _transaction.reset(token)
+            _mark_write()
+
+
+# SELECT，在 identity_map() 中时相同的并发查询共用一次执行
 async def select(sql, args, size=None):
-    log(sql, args)
-    async with __pool.acquire() as conn:
+    inflight = _inflight.get()
+    # 事务内的语句使用同一个连接，不能并发执行
+    if inflight is None or _transaction.get() is not None:
+        return await _select(sql, args, size)
+    try:
+        key = (sql, tuple(args or ()), size)
+        fut = inflight.get(key)
+    except TypeError:
+        # 参数不可哈希
+        return await _select(sql, args, size)
+    if fut is not None:
+        return list(await asyncio.shield(fut))
+    fut = inflight[key] = asyncio.get_running_loop().create_future()
+    try:
+        rows = await _select(sql, args, size)
+    except BaseException as e:
+        fut.set_exception(e)
+        # 避免无人等待时报 exception was never retrieved
+        fut.exception()
+        raise
+    else:
+        fut.set_result(rows)
+    finally:
+        # 只共享执行中的查询，完成后的查询不缓存结果
+        if inflight.get(key) is fut:
+            del inflight[key]
+    return list(rows)
+
+
+async def _select(sql, args, size=None):
+    async with acquire(readonly=True) as conn:
+        start = time.perf_counter()
         async with conn.cursor(aiomysql.DictCursor) as cur:
-            await cur.execute(sql.replace('?', '%s'), args or ())
+            await cur.execute(translate(sql), args or ())
             if size:
                 # 获取指定数量的记录
                 rows = await cur.fetchmany(size)
             else:
                 # 获取所有记录
                 rows = await cur.fetchall()
-            logging.info('Rows returned: %s' % len(rows))
-            return rows
+        profiler.observe(sql, args, time.perf_counter() - start, len(rows))
+        return rows
+
+
+# SELECT，使用服务端游标，按 batch_size 分批读取
+async def select_iter(sql, args, batch_size=1000):
+    async with acquire(readonly=True) as conn:
+        # 结果集保留在服务端，游标关闭前该连接不能执行其他语句
+        async with conn.cursor(aiomysql.SSDictCursor) as cur:
+            start = time.perf_counter()
+            await cur.execute(translate(sql), args or ())
+            # 只统计到开始返回数据，之后的耗时取决于调用方
+            seconds = time.perf_counter() - start
+            count = 0
+            try:
+                while True:
+                    rows = await cur.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    count += len(rows)
+                    for row in rows:
+                        yield row
+            finally:
+                profiler.observe(sql, args, seconds, count)
 
 
 # INSERT, UPDATE, DELETE
 async def execute(sql, args, autocommit=True):
-    log(sql)
-    async with __pool.acquire() as conn:
-        if not autocommit:
-            await conn.begin()
+    # autocommit 为 False 时在事务中执行，已在事务中则使用 SAVEPOINT
+    async with (acquire() if autocommit else transaction()) as conn:
+        start = time.perf_counter()
+        async with conn.cursor(aiomysql.DictCursor) as cur:
+            await cur.execute(translate(sql), args)
+            affected = cur.rowcount
+        profiler.observe(sql, args, time.perf_counter() - start, affected)
+    _mark_write()
+    _forget_inflight()
+    return affected
+
+
+# 批量 INSERT, UPDATE，在同一个事务中执行
+async def execute_many(sql, args_list, chunk_size=500):
+    affected = 0
+    async with transaction() as conn:
+        async with conn.cursor(aiomysql.DictCursor) as cur:
+            for i in range(0, len(args_list), chunk_size):
+                start = time.perf_counter()
+                # INSERT 会被合并为一条 INSERT ... VALUES (...), (...) 语句
+                await cur.executemany(translate(sql), args_list[i:i + chunk_size])
+                affected += cur.rowcount
+                profiler.observe(sql, '<%s rows>' % len(args_list[i:i + chunk_size]), time.perf_counter() - start,
+                                 cur.rowcount)
+    _forget_inflight()
+    return affected
+
+
+# 当前请求的 identity map：(Model, primary key) => Future of object or None
+_identity_map = contextvars.ContextVar('identity_map', default=None)
+# 当前请求执行中的 SELECT：(sql, args, size) => Future of rows
+_inflight = contextvars.ContextVar('inflight', default=None)
+
+
+@contextmanager
+def identity_map():
+    """
+    Within the block, Model.find returns the same object for the same primary key
+    and concurrent finds of it share one query. Concurrent select() calls with the same
+    SQL and args outside transaction, e.g. find_all or find_number, share one execution too.
+
+    Usage:
+        with orm.identity_map():
+            user = await User.find(uid)
+    """
+    token = _identity_map.set(dict())
+    inflight_token = _inflight.set(dict())
+    try:
+        yield
+    finally:
+        _inflight.reset(inflight_token)
+        _identity_map.reset(token)
+
+
+def _forget_inflight():
+    inflight = _inflight.get()
+    if inflight:
+        # 写入后开始的读取不能共用写入前开始的查询
+        inflight.clear()
+
+
+def on_change(model, listener):
+    """
+    Register a listener called after a row of model is saved, updated or removed.
+
+    :param model: Model subclass
+    :param listener: function(obj, action), action is one of 'save', 'update' and 'remove'
+    :return:
+    """
+    _listeners.setdefault(model, []).append(listener)
+
+
+def notify_change(obj, action):
+    imap = _identity_map.get()
+    if imap is not None:
+        # 写入后从 identity map 中移除，下次 find 重新查询
+        imap.pop((type(obj), obj.get_value(obj.__primary_key__)), None)
+    for listener in _listeners.get(type(obj), ()):
         try:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql.replace('?', '%s'), args)
-                affected = cur.rowcount
-            if not autocommit:
-                await conn.commit()
-        except BaseException:
-            if not autocommit:
-                await conn.rollback()
-            raise
-        return affected
+            listener(obj, action)
+        except Exception as e:
+            logger.exception(e)
+
+
+_listeners = dict()
+
+
+def chunk_ids(ids, chunk_size=500):
+    """
+    Split distinct ids into chunks, padding each chunk to a power of two by repeating its
+    last id, so IN (...) clauses come in a few shapes only.
+    """
+    ids = list(dict.fromkeys(i for i in ids if i is not None))
+    for i in range(0, len(ids), chunk_size):
+        chunk = ids[i:i + chunk_size]
+        n = 1
+        while n < len(chunk):
+            n *= 2
+        yield chunk + [chunk[-1]] * (n - len(chunk))
+
+
+async def prefetch(objs, key, model, attr, columns=None, defer=None):
+    """
+    Set obj[attr] to the model object whose primary key is obj[key], for all objs in
+    one query per chunk, e.g. prefetch(comments, 'user_id', User, 'user', columns=('name', 'image')).
+
+    Related objects are serialised with objs, so select only the columns that may be shown,
+    see models.prefetch_users.
+
+    :param columns: names of model to select as in find_all
+    :param defer: names of model not to select
+    :return: objs
+    """
+    related = await model.find_by_ids((obj.get(key) for obj in objs), columns=columns, defer=defer)
+    for obj in objs:
+        obj[attr] = related.get(obj.get(key))
+    return objs
+
+
+async def prefetch_count(objs, model, column, attr):
+    """
+    Set obj[attr] to the number of model rows whose column equals the primary key of obj,
+    e.g. prefetch_count(blogs, Comment, 'blog_id', 'comment_count').
+
+    :return: objs
+    """
+    counts = await model.count_by(column, (obj.get_value(obj.__primary_key__) for obj in objs))
+    for obj in objs:
+        obj[attr] = counts.get(obj.get_value(obj.__primary_key__), 0)
+    return objs
+
+
+def encode_cursor(values):
+    """
+    Encode the key values of the last row into an opaque pagination cursor.
+    """
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor: %s' % cursor)
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError('Invalid cursor: %s' % cursor)
+    return values
 
 
 def create_args_string(num):
@@ -67,11 +680,13 @@ def create_args_string(num):
 
 class Field(object):
 
-    def __init__(self, name, column_type, primary_key, default):
+    def __init__(self, name, column_type, primary_key, default, converter=None):
         self.name = name
         self.column_type = column_type
         self.primary_key = primary_key
         self.default = default
+        # 写入数据库前转换属性值的函数
+        self.converter = converter
 
     def __str__(self):
         return '<%s, %s:%s>' % (self.__class__.__name__, self.column_type, self.name)
@@ -79,7 +694,7 @@ class Field(object):
 
 class StringField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100'):
+    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)'):
         super().__init__(name, ddl, primary_key, default)
 
 
@@ -107,6 +722,73 @@ class TextField(Field):
         super().__init__(name, 'text', False, default)
 
 
+class Row(object):
+    """
+    Compact read-only row of a Model, storing fields in __slots__ instead of a dict.
+    Supports row.field and row['field'] in templates, and encoder.dumps(row).
+    """
+
+    __slots__ = ()
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs.get(name))
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return self.__slots__
+
+    def _asdict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__,
+                           ', '.join('%s=%r' % (name, getattr(self, name)) for name in self.__slots__))
+
+
+def make_args_builder(mappings, names, use_default):
+    """
+    Make a function building the args of names from a Model object in a single pass.
+
+    :param mappings: attribute name => Field
+    :param names: attribute names in the order of SQL placeholders
+    :param use_default: whether to fill None with the field default and store it in the object
+    :return: function(obj) -> list
+    """
+    specs = []
+    for name in names:
+        field = mappings[name]
+        default = field.default if use_default else None
+        if default is not None and not callable(default):
+            # 统一为无参函数
+            default = functools.partial(lambda value: value, default)
+        specs.append((name, default, field.converter))
+    specs = tuple(specs)
+
+    def build(obj):
+        get = obj.get
+        args = []
+        for name, default, converter in specs:
+            value = get(name)
+            if value is None and default is not None:
+                value = default()
+                obj[name] = value
+            if converter is not None and value is not None:
+                value = converter(value)
+            args.append(value)
+        return args
+
+    return build
+
+
 class ModelMetaclass(type):
 
     def __new__(mcs, name, bases, attrs):
@@ -115,14 +797,14 @@ class ModelMetaclass(type):
             return type.__new__(mcs, name, bases, attrs)
         # 获取 table 名称
         table_name = attrs.get('__table__', None) or name
-        logging.info('Found model: %s (table: %s)' % (name, table_name))
+        logger.info('Found model: %s (table: %s)', name, table_name)
         # 获取所有的 Field 和主键名
         mappings = dict()
         fields = []
         primary_key = None
         for k, v in attrs.items():
             if isinstance(v, Field):
-                logging.info('  Found mapping: %s ==> %s' % (k, v))
+                logger.info('  Found mapping: %s ==> %s', k, v)
                 mappings[k] = v
                 # 判断 v 是否是主键
                 if v.primary_key:
@@ -143,13 +825,22 @@ class ModelMetaclass(type):
         attrs['__primary_key__'] = primary_key
         # 除主键外的属性名
         attrs['__fields__'] = fields
-        # 构造默认的 SELECT, INSERT, UPDATE 和 DELETE 语句
-        attrs['__select__'] = 'SELECT %s, %s FROM %s' % (primary_key, ', '.join(fields), table_name)
+        # 属性名 => 列名
+        columns = dict((k, v.name or k) for k, v in mappings.items())
+        attrs['__columns__'] = columns
+        # 构造默认的 SELECT, INSERT, UPDATE 和 DELETE 语句，列名与属性名不同时使用别名
+        attrs['__select__'] = 'SELECT %s FROM %s' % (select_columns(columns, [primary_key] + fields), table_name)
         attrs['__insert__'] = 'INSERT INTO %s (%s, %s) VALUES (%s)' % (
-            table_name, ', '.join(fields), primary_key, create_args_string(len(fields) + 1))
+            table_name, ', '.join(map(lambda f: columns[f], fields)), columns[primary_key],
+            create_args_string(len(fields) + 1))
         attrs['__update__'] = 'UPDATE %s SET %s WHERE %s = ?' % (
-            table_name, ', '.join(map(lambda f: '%s = ?' % (mappings.get(f).name or f), fields)), primary_key)
-        attrs['__delete__'] = 'DELETE FROM %s WHERE %s = ?' % (table_name, primary_key)
+            table_name, ', '.join(map(lambda f: '%s = ?' % columns[f], fields)), columns[primary_key])
+        attrs['__delete__'] = 'DELETE FROM %s WHERE %s = ?' % (table_name, columns[primary_key])
+        # 与 INSERT 和 UPDATE 语句占位符顺序一致的参数构造函数
+        attrs['__insert_args__'] = make_args_builder(mappings, fields + [primary_key], True)
+        attrs['__update_args__'] = make_args_builder(mappings, fields + [primary_key], False)
+        # 紧凑的只读行类型，如 BlogRow
+        attrs['__row__'] = type('%sRow' % name, (Row,), dict(__slots__=tuple([primary_key] + fields)))
         return type.__new__(mcs, name, bases, attrs)
 
 
@@ -163,24 +854,105 @@ class Model(dict, metaclass=ModelMetaclass):
         try:
             return self[key]
         except KeyError:
+            if key in self.__dict__.get('_deferred', ()):
+                raise AttributeError(r"'Model' attribute '%s' is deferred, call load_deferred() first" % key)
             raise AttributeError(r"'Model' object has no attribute '%s'" % key)
 
     def __setattr__(self, key, value):
         self[key] = value
 
     def get_value(self, key):
-        return getattr(self, key, None)
+        return self.get(key)
 
     def get_value_or_default(self, key):
-        value = getattr(self, key, None)
+        value = self.get(key)
         if value is None:
             field = self.__mappings__[key]
             if field.default is not None:
                 value = field.default() if callable(field.default) else field.default
-                logging.debug('Using default value for %s: %s' % (key, str(value)))
-                setattr(self, key, value)
+                self[key] = value
         return value
 
+    @property
+    def deferred(self):
+        """
+        Names of fields not loaded by a find with columns= or defer=.
+        """
+        return self.__dict__.get('_deferred', frozenset())
+
+    @classmethod
+    def projection(cls, columns=None, defer=None):
+        """
+        Attribute names to select for columns= or defer=, the primary key is always selected.
+
+        :param columns: names to select
+        :param defer: names not to select
+        :return: tuple in declaration order, None to select all
+        """
+        if columns is None and defer is None:
+            return None
+        names = [cls.__primary_key__] + cls.__fields__
+        wanted = set(names if columns is None else columns) - set(defer or ())
+        unknown = wanted.union(defer or ()) - set(names)
+        if unknown:
+            raise ValueError('Unknown fields of %s: %s' % (cls.__name__, ', '.join(sorted(unknown))))
+        return tuple(n for n in names if n in wanted or n == cls.__primary_key__)
+
+    @classmethod
+    def row_factory(cls, fields=None, compact=False):
+        """
+        Function building an object from a row of build_select_sql(..., fields).
+        """
+        if compact:
+            return cls.__row__
+        if fields is None:
+            return cls
+        deferred = frozenset(cls.__fields__).difference(fields)
+
+        def make(**row):
+            obj = cls(**row)
+            # 保存在实例 __dict__ 中，不影响 dict 的内容
+            obj.__dict__['_deferred'] = deferred
+            return obj
+
+        return make
+
+    async def load_deferred(self):
+        """
+        Load the deferred fields of this object.
+        """
+        await self.undefer([self])
+        return self
+
+    @classmethod
+    async def undefer(cls, objs):
+        """
+        Load the deferred fields of objs with one query per chunk.
+
+        :param objs: objects returned by a find with columns= or defer=
+        :return: objs
+        """
+        deferred = set()
+        for obj in objs:
+            deferred.update(obj.deferred)
+        if not deferred:
+            return objs
+        pk = cls.__primary_key__
+        fields = tuple(n for n in [pk] + cls.__fields__ if n == pk or n in deferred)
+        loaded = dict()
+        for chunk in chunk_ids((obj[pk] for obj in objs if obj.deferred), 500):
+            sql = build_select_sql(cls, '%s IN (%s)' % (cls.__columns__[pk], create_args_string(len(chunk))),
+                                   None, None, fields)
+            for row in await select(sql, chunk):
+                loaded[row[pk]] = row
+        for obj in objs:
+            row = loaded.get(obj[pk])
+            if row is not None:
+                for name in obj.deferred:
+                    dict.__setitem__(obj, name, row[name])
+                obj.__dict__['_deferred'] = frozenset()
+        return objs
+
     @classmethod
     async def find_all(cls, where=None, args=None, **kwargs):
         """
@@ -188,33 +960,166 @@ class Model(dict, metaclass=ModelMetaclass):
 
         :param where:
         :param args:
+        :param kwargs: order_by, limit,
+                       columns or defer to select only some fields, load the others later
+                       with load_deferred() or undefer(),
+                       compact=True to return read-only cls.__row__ objects which take less
+                       memory than Model objects
+        :return:
+        """
+        sql, args = cls.build_select(where, args, **kwargs)
+        rows = await select(sql, args)
+        make = cls.row_factory(cls.projection(kwargs.get('columns'), kwargs.get('defer')), kwargs.get('compact', False))
+        return [make(**row) for row in rows]
+
+    @classmethod
+    async def iter_all(cls, where=None, args=None, batch_size=1000, **kwargs):
+        """
+        Iterate objects by WHERE clause, fetching batch_size rows at a time.
+
+        Usage:
+            async for blog in Blog.iter_all(order_by='created_at desc'):
+                ...
+
+        The connection is held until iteration ends, so exhaust the iterator or
+        close it with contextlib.aclosing().
+
+        :param where:
+        :param args:
+        :param batch_size:
         :param kwargs:
         :return:
         """
-        sql = [cls.__select__]
-        if where:
-            sql.append('WHERE')
-            sql.append(where)
-        if args is None:
-            args = []
-        order_by = kwargs.get('order_by', None)
-        if order_by:
-            sql.append('ORDER BY')
-            sql.append(order_by)
+        sql, args = cls.build_select(where, args, **kwargs)
+        make = cls.row_factory(cls.projection(kwargs.get('columns'), kwargs.get('defer')), kwargs.get('compact', False))
+        async for row in select_iter(sql, args, batch_size):
+            yield make(**row)
+
+    @classmethod
+    async def find_page(cls, where=None, args=None, cursor=None, size=20, key='created_at', **kwargs):
+        """
+        Find one page of objects ordered by (key, primary key) descending, using keyset
+        pagination, so every page costs the same as the first one.
+
+        Usage:
+            blogs, cursor = await Blog.find_page(size=10)
+            more, cursor = await Blog.find_page(cursor=cursor, size=10)
+
+        :param where:
+        :param args:
+        :param cursor: cursor returned by the previous page, None for the first page
+        :param size: page size
+        :param key: sort column, should be indexed, e.g. created_at
+        :param kwargs: columns, defer and compact as in find_all
+        :return: (objects, next cursor or None if there are no more pages)
+        """
+        pk = cls.__primary_key__
+        if key not in cls.__columns__:
+            raise ValueError('Unknown field of %s: %s' % (cls.__name__, key))
+        key_column = cls.__columns__[key]
+        conditions = ['(%s)' % where] if where else []
+        args = [] if args is None else list(args)
+        if cursor is not None:
+            last_key, last_pk = decode_cursor(cursor)
+            # 与 (key, pk) < (?, ?) 等价，但能使用 key 上的索引
+            conditions.append('(%s < ? OR (%s = ? AND %s < ?))' % (key_column, key_column, cls.__columns__[pk]))
+            args.extend([last_key, last_key, last_pk])
+        # 多取一条，用于判断是否还有下一页
+        fields = cls.projection(kwargs.get('columns'), kwargs.get('defer'))
+        if fields is not None and key not in fields:
+            # 游标需要 key 的值
+            fields = tuple(n for n in [pk] + cls.__fields__ if n in fields or n == key)
+        sql, args = cls.build_select(' AND '.join(conditions), args, fields=fields,
+                                     order_by='%s DESC, %s DESC' % (key_column, cls.__columns__[pk]), limit=size + 1)
+        rows = await select(sql, args)
+        make = cls.row_factory(fields, kwargs.get('compact', False))
+        objs = [make(**row) for row in rows[:size]]
+        if len(rows) <= size:
+            return objs, None
+        last = objs[-1]
+        return objs, encode_cursor([last[key], last[pk]])
+
+    @classmethod
+    def build_select(cls, where=None, args=None, **kwargs):
+        """
+        Build SELECT statement and args by WHERE clause, order_by and limit.
+
+        :param where:
+        :param args:
+        :param kwargs: order_by, limit, and columns or defer as in find_all
+        :return: (sql, args)
+        """
+        args = [] if args is None else list(args)
         limit = kwargs.get('limit', None)
         if limit is not None:
-            sql.append('LIMIT')
             if isinstance(limit, int):
-                sql.append('?')
                 args.append(limit)
+                limit = 1
             elif isinstance(limit, tuple) and len(limit) == 2:
-                sql.append('?, ?')
                 # 在 args 末尾一次性添加 limit 中的所有值
                 args.extend(limit)
+                limit = 2
             else:
                 raise ValueError('Invalid limit value: %s' % str(limit))
-        rows = await select(' '.join(sql), args)
-        return [cls(**row) for row in rows]
+        fields = kwargs.get('fields', None)
+        if fields is None:
+            fields = cls.projection(kwargs.get('columns', None), kwargs.get('defer', None))
+        return build_select_sql(cls, where, kwargs.get('order_by', None), limit, fields), args
+
+    @classmethod
+    async def find_by_ids(cls, ids, chunk_size=500, columns=None, defer=None):
+        """
+        Find objects by primary keys with one WHERE pk IN (...) query per chunk.
+
+        :param ids:
+        :param chunk_size:
+        :param columns: names to select as in find_all, e.g. to leave out User.password
+        :param defer: names not to select
+        :return: dict of primary key => object, missing keys are left out
+        """
+        result = dict()
+        missing = []
+        fields = cls.projection(columns, defer)
+        make = cls.row_factory(fields)
+        # 只选部分列时不使用 identity map，避免返回或缓存列不同的对象
+        imap = _identity_map.get() if fields is None else None
+        for pk in ids:
+            fut = imap.get((cls, pk)) if imap is not None else None
+            # 优先使用 identity map 中已查询完成的对象
+            if fut is not None and fut.done() and not fut.exception():
+                if fut.result() is not None:
+                    result[pk] = fut.result()
+            else:
+                missing.append(pk)
+        pk_name = cls.__primary_key__
+        for chunk in chunk_ids(missing, chunk_size):
+            sql = build_select_sql(cls, '%s IN (%s)' % (cls.__columns__[pk_name], create_args_string(len(chunk))),
+                                   None, None, fields)
+            for row in await select(sql, chunk):
+                obj = make(**row)
+                result[obj[pk_name]] = obj
+                if imap is not None and (cls, obj[pk_name]) not in imap:
+                    fut = imap[(cls, obj[pk_name])] = asyncio.get_running_loop().create_future()
+                    fut.set_result(obj)
+        return result
+
+    @classmethod
+    async def count_by(cls, column, values, chunk_size=500):
+        """
+        Count rows grouped by column for the given values with one query per chunk.
+
+        :param column:
+        :param values:
+        :param chunk_size:
+        :return: dict of value => count, values without rows are left out
+        """
+        result = dict()
+        for chunk in chunk_ids(values, chunk_size):
+            sql = build_number_sql(cls, '%s, COUNT(*)' % column,
+                                   '%s IN (%s) GROUP BY %s' % (column, create_args_string(len(chunk)), column))
+            for row in await select(sql, chunk):
+                result[row[column]] = row['_num_']
+        return result
 
     @classmethod
     async def find_number(cls, select_field, where=None, args=None):
@@ -226,45 +1131,116 @@ class Model(dict, metaclass=ModelMetaclass):
         :param args:
         :return:
         """
-        sql = ['SELECT %s _num_ FROM %s' % (select_field, cls.__table__)]
-        if where:
-            sql.append('WHERE')
-            sql.append(where)
-        rows = await select(' '.join(sql), args, 1)
+        rows = await select(build_number_sql(cls, select_field, where), args, 1)
         if len(rows) == 0:
             return None
         return rows[0]['_num_']
 
     @classmethod
-    async def find(cls, primary_key):
+    async def find(cls, primary_key, columns=None, defer=None):
         """
         Find object by primary key
 
         :param primary_key:
+        :param columns: names to select, as in find_all
+        :param defer: names not to select, as in find_all
         :return:
         """
-        rows = await select('%s WHERE %s = ?' % (cls.__select__, cls.__primary_key__), [primary_key], 1)
+        fields = cls.projection(columns, defer)
+        imap = _identity_map.get()
+        # 只加载部分字段的对象不放入 identity map
+        if imap is None or fields is not None:
+            return await cls.__find(primary_key, fields)
+        key = (cls, primary_key)
+        fut = imap.get(key)
+        if fut is not None:
+            # 已查询或正在查询
+            return await asyncio.shield(fut)
+        fut = imap[key] = asyncio.get_running_loop().create_future()
+        try:
+            obj = await cls.__find(primary_key)
+        except BaseException as e:
+            imap.pop(key, None)
+            fut.set_exception(e)
+            # 避免无人等待时报 exception was never retrieved
+            fut.exception()
+            raise
+        fut.set_result(obj)
+        return obj
+
+    @classmethod
+    async def __find(cls, primary_key, fields=None):
+        sql = build_select_sql(cls, '%s = ?' % cls.__columns__[cls.__primary_key__], None, None, fields)
+        rows = await select(sql, [primary_key], 1)
         if len(rows) == 0:
             return None
-        return cls(**rows[0])
+        return cls.row_factory(fields)(**rows[0])
+
+    @classmethod
+    async def save_all(cls, objs, chunk_size=500):
+        """
+        Insert objects in one transaction, chunk_size rows per statement.
+
+        :param objs:
+        :param chunk_size:
+        :return: total affected rows
+        """
+        args_list = []
+        for obj in objs:
+            args_list.append(obj.__insert_args__())
+        if not args_list:
+            return 0
+        rows = await execute_many(cls.__insert__, args_list, chunk_size)
+        if rows != len(args_list):
+            logger.warning('Failed to insert records: affected rows: %s of %s', rows, len(args_list))
+        for obj in objs:
+            notify_change(obj, 'save')
+        return rows
+
+    @classmethod
+    async def update_all(cls, objs, chunk_size=500):
+        """
+        Update objects by primary key in one transaction.
+
+        :param objs:
+        :param chunk_size:
+        :return: total affected rows
+        """
+        args_list = []
+        for obj in objs:
+            obj.check_loaded()
+            args_list.append(obj.__update_args__())
+        if not args_list:
+            return 0
+        rows = await execute_many(cls.__update__, args_list, chunk_size)
+        if rows != len(args_list):
+            logger.warning('Failed to update by primary key: affected rows: %s of %s', rows, len(args_list))
+        for obj in objs:
+            notify_change(obj, 'update')
+        return rows
 
     async def save(self):
-        args = list(map(self.get_value_or_default, self.__fields__))
-        args.append(self.get_value_or_default(self.__primary_key__))
-        rows = await execute(self.__insert__, args)
+        rows = await execute(self.__insert__, self.__insert_args__())
         if rows != 1:
-            logging.warning('Failed to insert record: affected rows: %s' % rows)
+            logger.warning('Failed to insert record: affected rows: %s', rows)
+        notify_change(self, 'save')
+
+    def check_loaded(self):
+        if self.deferred:
+            # 否则未加载的字段会被更新为 NULL
+            raise ValueError('Cannot update %s with deferred fields: %s, call load_deferred() first' % (
+                self.__class__.__name__, ', '.join(sorted(self.deferred))))
 
     async def update(self):
-        args = list(map(self.get_value, self.__fields__))
-        args.append(self.get_value(self.__primary_key__))
-        rows = await execute(self.__update__, args)
+        self.check_loaded()
+        rows = await execute(self.__update__, self.__update_args__())
         if rows != 1:
-            logging.warning('Failed to update by primary key: affected rows: %s' % rows)
+            logger.warning('Failed to update by primary key: affected rows: %s', rows)
+        notify_change(self, 'update')
 
     async def remove(self):
         args = [self.get_value(self.__primary_key__)]
-        print('args: %s' % args)
         rows = await execute(self.__delete__, args)
         if rows != 1:
-            logging.warning('Failed to remove by primary key: affected rows %s' % rows)
+            logger.warning('Failed to remove by primary key: affected rows %s', rows)
+        notify_change(self, 'remove')
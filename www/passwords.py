@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+# @author xian_wen
+# @date 10/18/2026 10:05 PM
+
+"""
+Password hashing with a slow KDF run in a bounded executor, so logins do not block the event loop.
+
+Stored formats:
+    pbkdf2_sha256$<iterations>$<salt>$<hash>
+    scrypt$<n>$<r>$<p>$<salt>$<hash>
+    <40 hex digits>    legacy sha1(uid:password), only verified, rehashed on login
+
+Usage:
+    password = await passwords.hash_password(raw)
+    ok, new_password = await passwords.verify_password(raw, user.password, user.id)
+    if new_password:
+        user.password = new_password  # and save it
+"""
+
+import asyncio
+import base64
+import functools
+import hashlib
+import hmac
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+def _b64encode(b):
+    return base64.b64encode(b).decode('ascii').rstrip('=')
+
+
+def _b64decode(s):
+    return base64.b64decode(s + '=' * (-len(s) % 4))
+
+
+# 以下函数在 executor 中运行，须为模块级函数以便进程池序列化
+def pbkdf2(password, salt, iterations, digest='sha256'):
+    return hashlib.pbkdf2_hmac(digest, password.encode('utf-8'), salt, iterations)
+
+
+def scrypt(password, salt, n, r, p):
+    # maxmem 至少为 128 * n * r * p
+    return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r * p)
+
+
+def legacy_sha1(password, uid):
+    return hashlib.sha1(('%s:%s' % (uid, password)).encode('utf-8')).hexdigest()
+
+
+class PBKDF2Hasher(object):
+    algorithm = 'pbkdf2_sha256'
+    # 是否直接在事件循环中计算
+    inline = False
+
+    def __init__(self, iterations=600000):
+        self.iterations = iterations
+
+    def encode(self, password):
+        """
+        :return: (fn, make), fn() computes the key in the executor and make(key) returns the string to store
+        """
+        salt = os.urandom(16)
+        return (functools.partial(pbkdf2, password, salt, self.iterations),
+                lambda key: '%s$%d$%s$%s' % (self.algorithm, self.iterations, _b64encode(salt), _b64encode(key)))
+
+    def verify(self, password, encoded, uid):
+        """
+        :return: (fn, expected), password is right if fn() equals expected
+        """
+        _, iterations, salt, key = encoded.split('$')
+        return functools.partial(pbkdf2, password, _b64decode(salt), int(iterations)), _b64decode(key)
+
+    def needs_update(self, encoded):
+        return int(encoded.split('$')[1]) != self.iterations
+
+
+class ScryptHasher(object):
+    algorithm = 'scrypt'
+    inline = False
+
+    def __init__(self, n=16384, r=8, p=1):
+        self.n = n
+        self.r = r
+        self.p = p
+
+    def encode(self, password):
+        salt = os.urandom(16)
+        return (functools.partial(scrypt, password, salt, self.n, self.r, self.p),
+                lambda key: '%s$%d$%d$%d$%s$%s' % (self.algorithm, self.n, self.r, self.p,
+                                                   _b64encode(salt), _b64encode(key)))
+
+    def verify(self, password, encoded, uid):
+        _, n, r, p, salt, key = encoded.split('$')
+        return functools.partial(scrypt, password, _b64decode(salt), int(n), int(r), int(p)), _b64decode(key)
+
+    def needs_update(self, encoded):
+        return encoded.split('$')[1:4] != [str(self.n), str(self.r), str(self.p)]
+
+
+class LegacySHA1Hasher(object):
+    """
+    The original sha1(uid:password) hex digest, fast enough to verify inline, never used for new passwords.
+    """
+    algorithm = 'sha1'
+    inline = True
+
+    def verify(self, password, encoded, uid):
+        return functools.partial(legacy_sha1, password, uid), encoded
+
+    def needs_update(self, encoded):
+        return True
+
+
+# algorithm => hasher，新密码使用 _hasher
+_hashers = dict(sha1=LegacySHA1Hasher())
+_hasher = None
+
+_executor = None
+_executor_options = dict(executor='thread', max_workers=0)
+_max_pending = 64
+# 同时在 executor 中排队和计算的哈希数，超出时在事件循环中等待
+_pending = None
+
+
+def register(hasher):
+    """
+    Register a hasher like PBKDF2Hasher, stored strings starting with its algorithm are verified by it.
+    """
+    _hashers[hasher.algorithm] = hasher
+
+
+def configure(algorithm='pbkdf2_sha256', iterations=600000, scrypt_n=16384, scrypt_r=8, scrypt_p=1,
+              executor='thread', max_workers=0, max_pending=64):
+    """
+    :param algorithm: hasher of new passwords, pbkdf2_sha256 or scrypt
+    :param iterations: PBKDF2 iterations
+    :param executor: 'thread', 'process' or None to hash on the calling thread
+    :param max_workers: executor size, 0 for the number of CPUs
+    :param max_pending: max hashes queued or running in the executor
+    """
+    global _hasher, _executor_options, _max_pending, _pending
+    register(PBKDF2Hasher(iterations))
+    register(ScryptHasher(scrypt_n, scrypt_r, scrypt_p))
+    _hasher = _hashers[algorithm]
+    shutdown()
+    _executor_options = dict(executor=executor, max_workers=max_workers)
+    _max_pending = max_pending
+    _pending = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        max_workers = _executor_options['max_workers'] or os.cpu_count() or 1
+        if _executor_options['executor'] == 'process':
+            # 不 fork 已有线程的 worker 进程
+            _executor = ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context('spawn'))
+        else:
+            # hashlib 计算时释放 GIL，线程池即可利用多核
+            _executor = ThreadPoolExecutor(max_workers, thread_name_prefix='passwords')
+    return _executor
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+
+
+async def _run(fn):
+    global _pending
+    if _executor_options['executor'] is None:
+        return fn()
+    if _pending is None:
+        _pending = asyncio.Semaphore(_max_pending)
+    async with _pending:
+        return await asyncio.get_running_loop().run_in_executor(_get_executor(), fn)
+
+
+def _hasher_of(encoded):
+    if '$' not in encoded:
+        return _hashers['sha1']
+    return _hashers.get(encoded.split('$', 1)[0])
+
+
+async def hash_password(password):
+    """
+    Hash password with the configured hasher.
+
+    :return: string to store
+    """
+    fn, make = _hasher.encode(password)
+    return make(await _run(fn))
+
+
+async def verify_password(password, encoded, uid):
+    """
+    Check password against the stored string.
+
+    :param uid: user id, salt of the legacy format
+    :return: (ok, new encoded string if it should be rehashed with the configured hasher else None)
+    """
+    hasher = _hasher_of(encoded or '')
+    if hasher is None:
+        logger.warning('Unknown password hash of user %s', uid)
+        return False, None
+    try:
+        fn, expected = hasher.verify(password, encoded, uid)
+    except ValueError:
+        logger.warning('Malformed password hash of user %s', uid)
+        return False, None
+    actual = fn() if hasher.inline else await _run(fn)
+    if not hmac.compare_digest(actual, expected):
+        return False, None
+    if hasher is not _hasher or hasher.needs_update(encoded):
+        return True, await hash_password(password)
+    return True, None
+
+
+configure()
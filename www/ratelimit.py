@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# @author xian_wen
+# @date 10/18/2026 11:20 PM
+
+"""
+Token bucket rate limits of routes, declared with @get/@post(path, rate_limit={key: (capacity, period)}).
+
+A bucket holds up to capacity tokens and refills capacity tokens per period seconds, each request takes one.
+
+Usage:
+    allowed, retry_after = await ratelimit.take('/api/authenticate:ip:10.0.0.1', 20, 60)
+    ratelimit.use(MyBackend())  # e.g. shared by all worker processes
+"""
+
+import time
+
+from aiohttp import web
+
+from cache import LRUCache
+from coroweb import read_post_params
+
+
+class MemoryBackend(object):
+    """
+    Buckets of this process in an LRU cache, an evicted or expired bucket is full again.
+    """
+
+    def __init__(self, maxsize=100000):
+        # key => (tokens, updated)
+        self.buckets = LRUCache(maxsize)
+
+    async def take(self, key, capacity, period, cost=1):
+        """
+        Take cost tokens from the bucket of key.
+
+        :return: (allowed, seconds until enough tokens if not allowed else 0)
+        """
+        rate = capacity / period
+        now = time.time()
+        entry = self.buckets.get(key)
+        tokens = capacity if entry is None else min(capacity, entry[0] + (now - entry[1]) * rate)
+        if tokens < cost:
+            return False, (cost - tokens) / rate
+        tokens -= cost
+        # 桶装满后记录可以丢弃
+        self.buckets.set(key, (tokens, now), (capacity - tokens) / rate)
+        return True, 0
+
+    def __len__(self):
+        return len(self.buckets)
+
+
+backend = MemoryBackend()
+
+
+def use(b):
+    """
+    Use backend b with a coroutine take(key, capacity, period) -> (allowed, retry_after) like MemoryBackend.
+    """
+    global backend
+    backend = b
+
+
+async def take(key, capacity, period):
+    return await backend.take(key, capacity, period)
+
+
+async def limit_value(request, key, ip_header=''):
+    """
+    Value of a rate limit key in the request, None if absent.
+
+    :param key: 'ip' for the client address, otherwise an argument name in match_info, then in the
+                POST body or the query of other requests, the same source RequestHandler binds it from
+    :param ip_header: header with the client address set by a trusted proxy, e.g. X-Real-IP
+    """
+    if key == 'ip':
+        return (ip_header and request.headers.get(ip_header)) or request.remote
+    if key in request.match_info:
+        return request.match_info[key]
+    if request.method != 'POST':
+        return request.query.get(key)
+    # POST 参数只从请求体绑定，不能读取 query，否则 ?email=<随机值> 可以绕过同一邮箱的限制
+    try:
+        params = await read_post_params(request)
+    except web.HTTPBadRequest:
+        # 由 handler 返回 400
+        return None
+    value = params.get(key)
+    if isinstance(value, str):
+        # 同一邮箱的不同写法共用一个桶
+        return value.strip().lower()
+    return None
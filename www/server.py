@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+# @author xian_wen
+# @date 10/18/2026 9:10 PM
+
+"""
+Serve app.py with several worker processes sharing one listening port.
+
+The master process only binds the socket and watches the workers, each worker imports app.py after fork,
+so a reload also picks up changed code.
+
+Usage:
+    python server.py             # configs.server.workers workers
+    kill -HUP <master pid>       # graceful reload: replace the workers one at a time
+    kill -TERM <master pid>      # graceful shutdown
+
+Each worker keeps its own session and page caches, a write only invalidates those of the worker that made it,
+so their TTLs are capped to configs.server.worker_cache_ttl with more than one worker.
+During a reload one extra worker runs, so up to configs.db.maxsize plus one worker's share of connections are open.
+"""
+
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+import logs
+from config import configs
+
+logger = logging.getLogger('server')
+
+# worker 启动后存活不足该时间（秒）就退出，视为启动失败，延迟重启
+MIN_WORKER_LIFETIME = 1.0
+
+
+def bind_socket(host, port, backlog=128):
+    """
+    Bind the listening socket inherited by all workers.
+    """
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(sock, workers, options):
+    """
+    Run one worker in the forked process until SIGTERM or SIGINT.
+    """
+    from aiohttp import web
+
+    import app
+    web_app = app.init_app(workers=workers)
+    if sock is None:
+        web.run_app(web_app, host=options.host, port=options.port, reuse_port=True,
+                    shutdown_timeout=options.shutdown_timeout, print=None)
+    else:
+        web.run_app(web_app, sock=sock, shutdown_timeout=options.shutdown_timeout, print=None)
+
+
+def spawn_worker(sock, workers, options):
+    """
+    Fork a worker.
+
+    :return: pid of the worker
+    """
+    pid = os.fork()
+    if pid:
+        return pid
+    # 子进程：恢复默认信号处理，由 aiohttp 处理 SIGTERM 和 SIGINT
+    for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+        signal.signal(sig, signal.SIG_DFL)
+    # 写日志的线程不会随 fork 复制
+    logs.init_logging(**configs.logging)
+    code = 0
+    try:
+        run_worker(sock, workers, options)
+    except BaseException:
+        logger.exception('Worker %s failed', os.getpid())
+        code = 1
+    finally:
+        logs.stop_logging()
+        os._exit(code)
+
+
+class Master(object):
+    """
+    Keep options.workers workers running, restart crashed ones, reload on SIGHUP and stop on SIGTERM.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.workers = options.workers or os.cpu_count() or 1
+        # SO_REUSEPORT 时每个 worker 各自监听
+        self.sock = None if options.reuse_port else bind_socket(options.host, options.port)
+        # pid => 启动时间
+        self.children = dict()
+        # 重载时等待退出的旧 worker
+        self.retiring = set()
+        # 重载时尚未替换的旧 worker
+        self.replacing = []
+        self.reloading = False
+        self.stopping = False
+
+    def spawn(self):
+        pid = spawn_worker(self.sock, self.workers, self.options)
+        self.children[pid] = time.time()
+        logger.info('Started worker %s', pid)
+
+    def kill(self, pids, sig=signal.SIGTERM):
+        for pid in pids:
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def reap(self):
+        """
+        Collect exited workers, start a replacement for each crashed or exited current worker.
+        """
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            started = self.children.pop(pid, None)
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+                logger.info('Retired worker %s', pid)
+                continue
+            if started is None or self.stopping:
+                continue
+            logger.error('Worker %s exited with status %s, restarting', pid, os.waitstatus_to_exitcode(status))
+            if time.time() - started < MIN_WORKER_LIFETIME:
+                # 避免启动即失败时不断 fork
+                time.sleep(MIN_WORKER_LIFETIME)
+            self.spawn()
+
+    def reload(self):
+        logger.info('Reloading %s workers', self.workers)
+        self.replacing = [pid for pid in self.children if pid not in self.retiring]
+
+    def replace_next(self):
+        """
+        Replace one old worker once the previous one has exited, so at most one extra connection pool is open.
+        """
+        while self.replacing and not self.retiring:
+            pid = self.replacing.pop(0)
+            # 已退出的 worker 由 reap 以新代码重启
+            if pid not in self.children:
+                continue
+            self.spawn()
+            # 新 worker 启动期间连接在监听队列中等待，旧 worker 处理完当前请求后退出
+            self.retiring.add(pid)
+            self.kill([pid])
+
+    def stop(self):
+        logger.info('Stopping %s workers', len(self.children))
+        self.kill(self.children)
+        deadline = time.time() + self.options.shutdown_timeout + 5
+        while self.children and time.time() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        self.kill(self.children, signal.SIGKILL)
+        while self.children:
+            pid, _ = os.waitpid(-1, 0)
+            self.children.pop(pid, None)
+
+    def run(self):
+        signal.signal(signal.SIGHUP, lambda signum, frame: setattr(self, 'reloading', True))
+        signal.signal(signal.SIGTERM, lambda signum, frame: setattr(self, 'stopping', True))
+        signal.signal(signal.SIGINT, lambda signum, frame: setattr(self, 'stopping', True))
+        logger.info('Master %s serving on %s:%s with %s workers%s', os.getpid(), self.options.host,
+                    self.options.port, self.workers, ' (SO_REUSEPORT)' if self.sock is None else '')
+        for i in range(self.workers):
+            self.spawn()
+        while not self.stopping:
+            if self.reloading:
+                self.reloading = False
+                self.reload()
+            self.reap()
+            self.replace_next()
+            time.sleep(0.2)
+        self.stop()
+        if self.sock is not None:
+            self.sock.close()
+
+
+def main():
+    if not hasattr(os, 'fork'):
+        sys.exit('server.py needs os.fork, run python app.py instead')
+    logs.init_logging(**configs.logging)
+    Master(configs.server).run()
+
+
+if __name__ == '__main__':
+    main()
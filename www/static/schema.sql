@@ -7,7 +7,7 @@ USE awesome;
 CREATE TABLE users (
     id         VARCHAR(50) NOT NULL,
     email      VARCHAR(50) NOT NULL,
-    password   VARCHAR(50) NOT NULL,
+    password   VARCHAR(200) NOT NULL,
     admin      BOOL        NOT NULL,
     name       VARCHAR(50) NOT NULL,
     image      VARCHAR(50) NOT NULL,
@@ -12,9 +12,7 @@ async def test():
     a = User(name='Administrator', email='admin@example.com', password='1234567890', image='about:blank')
     x = User(name='xian_wen', email='xian_wen@example.com', password='1234567890', image='about:blank')
     t = User(name='Test', email='test@example.com', password='1234567890', image='about:blank')
-    await a.save()
-    await x.save()
-    await t.save()
+    await User.save_all([a, x, t])
 
 
 loop = asyncio.get_event_loop()